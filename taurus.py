@@ -9,10 +9,27 @@ import taurusGUI
 import datetime
 import pickle
 import os
+import random
 import sys
+import bisect
+import collections
+import concurrent.futures
+import csv
 import hashlib
+import heapq
+import io
+import math
+import multiprocessing
+import queue
+import re
+import threading
+import unicodedata
 import xml.sax as SAX
 import xml.sax.saxutils as SAXUTILS
+try:
+    import numpy as NP      # optional: used for cohort-wide calculations when installed
+except ImportError:
+    NP = None
 
 # Global constants
 
@@ -72,6 +89,7 @@ class Student():
         self.cycle_no = cycle
         self.pcode = pcode
         self.choices = {} # key = date, value = list of Choice objects for this student
+        self.outcomecache = {} # key = date, value = outcome counts and firm/insc - see getOutcomeSummary
         # track interviews
         self.interviews = {} # key = choice ID, value = date
         self.isnew = True # set to false once we have an ASR history for this student
@@ -237,35 +255,64 @@ class Student():
     def __str__(self):
         return self.getName()
 
+    def __getstate__(self):
+        # outcome summaries are rebuilt when needed so aren't saved
+        state = self.__dict__.copy()
+        state['outcomecache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        # students pickled before the outcome cache have none
+        self.__dict__.update(state)
+        if 'outcomecache' not in state:
+            self.outcomecache = {}
+
     def addChoice(self, thedate, choice):
         if thedate in self.choices:
             if choice not in self.choices[thedate]:     # eg if re-importing an asr ?????????
                 self.choices[thedate].append(choice)
         else:                                           # first choice for this date
             self.choices[thedate] = [choice]
+        self.outcomecache.pop(thedate, None)
         return choice
 
+    def getOutcomeSummary(self, thedate):
+        # (counts by exact outcome, counts by outcome prefix, firm, insc) for the choices at this date
+        # built on first use and dropped by addChoice
+        try:
+            return self.outcomecache[thedate]
+        except KeyError:
+            pass
+        exact = {}
+        prefix = {}
+        firm = None
+        insc = None
+        for choice in self.getChoices(thedate):
+            outcome = choice.getFullOutcome()
+            exact[outcome] = exact.get(outcome, 0) + 1
+            for n in range(len(outcome) + 1):
+                prefix[outcome[:n]] = prefix.get(outcome[:n], 0) + 1
+            if firm is None and choice.isFirm():
+                firm = choice
+            if insc is None and choice.isInsc():
+                insc = choice
+        summary = self.outcomecache[thedate] = (exact, prefix, firm, insc)
+        return summary
+
     def countChoices(self, thedate, target, exact):
         if thedate not in self.choices:     # in case student has no choices at this date
             return 0
-        if exact:
-            return sum([1 for i in self.choices[thedate] if i.outcome == target])
-        else:
-            return sum([1 for i in self.choices[thedate] if i.outcome[:len(target)] == target])
+        return self.getOutcomeSummary(thedate)[0 if exact else 1].get(target, 0)
 
     def getFirm(self, thedate):
-        if thedate in self.choices:         # in case student has no choices at this date
-            for choice in self.choices[thedate]:
-                if choice.isFirm():
-                    return choice
-        return None
+        if thedate not in self.choices:     # in case student has no choices at this date
+            return None
+        return self.getOutcomeSummary(thedate)[2]
 
     def getInsc(self, thedate):
-        if thedate in self.choices:         # in case student has no choices at this date
-            for choice in self.choices[thedate]:
-                if choice.isInsc():
-                        return choice
-        return None
+        if thedate not in self.choices:     # in case student has no choices at this date
+            return None
+        return self.getOutcomeSummary(thedate)[3]
 
     def addResult(self, result):
         unit = result.getUnitCode()
@@ -286,7 +333,7 @@ class Student():
 
     def getResultsAsOffer(self):
         # Return an Offer object made from grades that 'count' i.e. qual level results
-        return Offer(''.join([result.getGrade() for code, result in self.results.items()]))
+        return Offer.fromString(''.join([result.getGrade() for code, result in self.results.items()]))
 
     def addPrediction(self, simsname, grade):
         # adds/updates predicted grade - returns old value if updated
@@ -313,7 +360,7 @@ class Student():
         g = ''
         for simsname in self.predicted:
             g += self.predicted[simsname]
-        return Offer(g)
+        return Offer.fromString(g)
 
     def getPredictedGradeString(self, n=-1):
         o = self.getPredictionsAsOffer()
@@ -410,6 +457,11 @@ class Match:
 
 class Choice():
 
+    # flags decoded from the outcome string
+    FIRM        = 1
+    INSC        = 2
+    DECLINED    = 4
+
     def __init__(self, choiceid, unicode, unitext, crscode, crstext, outcome, offer):
         self.choiceid = choiceid
         self.unicode = unicode
@@ -417,10 +469,11 @@ class Choice():
         self.crscode = crscode
         self.crstext = crstext
         self.outcome = outcome
+        self.decodeOutcome()
         if self.getOutcome() == Outcome.U:
-            self.offer = Offer('')                 # some unis leave grades even if U
+            self.offer = Offer.fromString('')                  # some unis leave grades even if U
         else:
-            self.offer = Offer(offer.strip())       # grades in ASR often incl whitespace
+            self.offer = Offer.fromString(offer.strip())       # grades in ASR often incl whitespace
         self.updated = Update.UPD8_UNDEFINED
 
     # Get methods
@@ -450,20 +503,38 @@ class Choice():
         return self.outcome
 
     def getOutcome(self):
+        return self.kind
+
+    def decodeOutcome(self):
+        # outcome string is decoded once into kind (Outcome.C etc) and flags
         if self.outcome[0] == 'C':
-            return Outcome.C
+            self.kind = Outcome.C
         elif self.outcome[0] == 'U':
-            return Outcome.U
+            self.kind = Outcome.U
         elif self.outcome == 'REJ':
-            return Outcome.REJ
+            self.kind = Outcome.REJ
         elif self.outcome == 'INV':
-            return Outcome.INV
+            self.kind = Outcome.INV
         elif self.outcome == 'REF':
-            return Outcome.REF
+            self.kind = Outcome.REF
         elif self.outcome[0] == 'W':
-            return Outcome.W
+            self.kind = Outcome.W
         else:
             raise RuntimeError("getOutcome: invalid outcome "+self.outcome)  # need to handle any other cases?
+        self.flags = 0
+        if len(self.outcome) >= 2:
+            if self.outcome[1] == 'F':
+                self.flags |= Choice.FIRM
+            elif self.outcome[1] == 'I':
+                self.flags |= Choice.INSC
+        if self.outcome[:2] in ('CD', 'UD'):
+            self.flags |= Choice.DECLINED
+
+    def __setstate__(self, state):
+        # choices pickled before outcomes were decoded have no kind/flags
+        self.__dict__.update(state)
+        if 'kind' not in state:
+            self.decodeOutcome()
 
     def getUpdated(self):
         return self.updated
@@ -512,16 +583,105 @@ class Choice():
             self.setUpdated(Update.UPD8_NEW)
 
     def isFirm(self):
-        if len(self.outcome) >= 2:
-            if self.outcome[1] == 'F':
-                return True
-        return False
+        return self.flags & Choice.FIRM != 0
 
     def isInsc(self):
-        if len(self.outcome) >= 2:
-            if self.outcome[1] == 'I':
-                return True
-        return False
+        return self.flags & Choice.INSC != 0
+
+    def isDeclined(self):
+        return self.flags & Choice.DECLINED != 0
+
+class Tariff():
+
+    # UCAS tariff tables, one per tariff year so old and new rules can sit side by side
+    # POINTS[year] gives the points for each A level grade in GRADES order
+    GRADES      =   'EDCBA@'
+    POINTS      =   { 2017: [16, 24, 32, 40, 48, 56] }
+    CURRENTYEAR =   2017
+    KEYLENGTH   =   4       # sorted grade keys up to this many grades are tabulated
+    tariffs     =   {}      # k=year, v=Tariff
+
+    @staticmethod
+    def forYear(year=None):
+        if year is None:
+            year = Tariff.CURRENTYEAR
+        try:
+            return Tariff.tariffs[year]
+        except KeyError:
+            tariff = Tariff.tariffs[year] = Tariff(year, Tariff.POINTS[year])
+            return tariff
+
+    def __init__(self, year, points):
+        self.year = year
+        self.letternumbers = {g: n for n, g in enumerate(Tariff.GRADES)}
+        self.letterpoints = dict(zip(Tariff.GRADES, points))
+        # every sorted grade key (as Offer.gradekey) to its points value
+        self.keypoints = {'': 0}
+        keys = ['']
+        for length in range(Tariff.KEYLENGTH):
+            keys = {''.join(sorted(key + g)) for key in keys for g in Tariff.GRADES}
+            for key in keys:
+                self.keypoints[key] = sum([self.letterpoints[g] for g in key])
+        # every points value to the grade triple a points offer is read as: grades are dropped
+        # one at a time from the top (A*A*A*, AA*A*, AAA*, AAA, BAA, ...) until the total is no
+        # more than the offer; below EEE the offer is treated as EEE, above A*A*A* as A*A*A*
+        trial = [len(points) - 1] * 3
+        self.equivalents = []
+        self.maxpoints = sum([points[n] for n in trial])
+        triples = [(self.maxpoints, self.gradeString(trial))]
+        while max(trial) > 0:
+            i = trial.index(max(trial))
+            trial[i] -= 1
+            triples.append((sum([points[n] for n in trial]), self.gradeString(trial)))
+        triples.reverse()
+        self.minpoints = triples[0][0]
+        for value in range(self.maxpoints + 1):
+            while len(triples) > 1 and triples[1][0] <= value:
+                triples.pop(0)
+            self.equivalents.append(triples[0][1])
+
+    def gradeString(self, numbers):
+        return ''.join([Tariff.GRADES[n] for n in numbers])
+
+    def getYear(self):
+        return self.year
+
+    def gradesForPoints(self, value):
+        # grade triple equivalent to a points offer
+        if value > self.maxpoints:
+            return self.equivalents[-1]
+        return self.equivalents[max(value, 0)]
+
+    def pointsForKey(self, key):
+        # points for a string of grade letters, None if it includes anything not a grade
+        try:
+            return self.keypoints[key]
+        except KeyError:
+            pass
+        try:
+            return self.keypoints[''.join(sorted(key))]
+        except KeyError:
+            pass
+        try:
+            return sum([self.letterpoints[g] for g in key])
+        except KeyError:
+            return None
+
+    def pointsForLetter(self, letter):
+        try:
+            return self.letterpoints[letter]
+        except KeyError:
+            raise ValueError('not a grade: ' + letter)
+
+    def letterToNumber(self, letter):
+        try:
+            return self.letternumbers[letter]
+        except KeyError:
+            raise ValueError('not a grade: ' + letter)
+
+    def gradeNumbers(self, grades):
+        # grades as numbers (E=0 .. A*=5), -1 for anything not a grade
+        return tuple([self.letternumbers.get(g, -1) for g in grades])
 
 class Offer:
     
@@ -539,6 +699,17 @@ class Offer:
     DESCRIPTIONS =  ['Met', 'Above 1', 'Above 2+', 'Below 1', 'Below 2+',
                     'Up1Dn1', 'Mixed', 'CHECK', 'No Offer']
     SPECIALCONDITIONS = 1000    # sentinel for special academic offer
+    # transition matrix for gradeCompare cases: g<o-1,g=o-1,g=o,g=o+1,g>o+1
+    # TRANSITIONS[currentstate][case] = newstate
+    TRANSITIONS =   [ [4,3,0,1,2], [6,5,1,2,2], [6,6,2,2,2], [4,4,3,5,6],
+                      [4,4,4,6,6], [6,6,5,6,6], [6,6,6,6,6] ]
+
+    # Offers are immutable and a cohort only has a few hundred distinct offer strings, so they are
+    # interned: use Offer.fromString rather than the constructor so each string is parsed once
+    CACHESIZE   =   4096
+    cache       =   {}      # k=grade string, v=Offer - oldest entries dropped when full
+    cachehits   =   0
+    cachemisses =   0
 
     def __init__(self, gradestring):
         # Keep copy of raw conditions with all whitespace gone and A*s not @s
@@ -560,6 +731,44 @@ class Offer:
             self.gradekey = grades                  # a string representing the integer offer
         except:
             self.gradekey = ''.join(sorted(grades)) # a string of grades in order
+        self.setDerivedValues()
+
+    @staticmethod
+    def fromString(gradestring):
+        try:
+            offer = Offer.cache[gradestring]
+        except KeyError:
+            Offer.cachemisses += 1
+            if len(Offer.cache) >= Offer.CACHESIZE:
+                del Offer.cache[next(iter(Offer.cache))]
+            offer = Offer.cache[gradestring] = Offer(gradestring)
+        else:
+            Offer.cachehits += 1
+        return offer
+
+    @staticmethod
+    def getCacheStats():
+        return {'hits': Offer.cachehits, 'misses': Offer.cachemisses, 'size': len(Offer.cache)}
+
+    def __reduce__(self):
+        # pickle just the grade string so loaded offers are interned too
+        return (Offer.fromString, (self.rawgrades,))
+
+    def __setstate__(self, state):
+        # offers pickled before interning have no derived values
+        self.__dict__.update(state)
+        self.setDerivedValues()
+
+    def setDerivedValues(self):
+        try:
+            int(self.gradekey)
+            self.pointsoffer = True
+        except:
+            self.pointsoffer = False
+        self.gradeequivalent = self.calculateGradeEquivalent()
+        self.gradevalue = self.calculateGradeValue()
+        # grade equivalent as numbers for gradeCompare, -1 for anything not a grade
+        self.gradenumbers = Tariff.forYear().gradeNumbers(self.gradeequivalent)
 
     def getFullGrades(self):
         return self.rawgrades
@@ -572,40 +781,44 @@ class Offer:
         return len(self.gradekey)
 
     def isPointsOffer(self):
-        try:
-            value = int(self.getGrades())  # points offer
-            return True
-        except:
-            return False
+        return self.pointsoffer
 
     def getGradeValue(self):        # turns offer grades into UCAS points value
+        return self.gradevalue
+
+    def getBestGradeValue(self, count=3):
+        # points for the best count grades - a fourth A level doesn't make up for lower grades in an offer
+        if self.isPointsOffer() or self.numGrades() <= count:
+            return self.getGradeValue()
+        return Offer.fromString(self.gradekey[:count]).getGradeValue()     # gradekey is best first
+
+    def getGradeEquivalent(self, astar=False):   # turns a points offer into equivalent grades
+        if not self.isPointsOffer():
+            return self.getGrades(astar)
+        return self.gradeequivalent
+
+    def calculateGradeValue(self):
         grades = self.getGradeEquivalent()
         if grades == '':    # no grade conditions
             if self.getFullGrades().rstrip(JCQ.UCAS_IGNORE) == '': # conditions that amount to U
                 return 0    # this is effectively unconditional
             else:
                 return Offer.SPECIALCONDITIONS      # ensure special academic conditions are considered unattainable
-        value = 0
-        for g in grades:
-            try:
-                value += self.gradeLettertoPoints(g)
-            except ValueError:
-                logwrite('#grade ' + g + ' not recognised - ignoring')
+        value = Tariff.forYear().pointsForKey(grades)
+        if value is None:
+            value = 0
+            for g in grades:
+                try:
+                    value += self.gradeLettertoPoints(g)
+                except ValueError:
+                    logwrite('#grade ' + g + ' not recognised - ignoring')
         return value
 
-    def getGradeEquivalent(self, astar=False):   # turns a points offer into equivalent grades
-        grades = self.getGrades(astar)
+    def calculateGradeEquivalent(self):
         if not self.isPointsOffer():
-            return grades
+            return self.getGrades()
         else:
-            value = int(grades)
-            trial = [5, 5, 5]             # start at three A*s
-            trialvalue = 168
-            while trialvalue > value:
-                i = trial.index(max(trial))
-                trial[i] -= 1           # decrease until we hit the right grade value
-                trialvalue = sum([self.gradeNumbertoPoints(trial[i]) for i in range(3)])
-            return ''.join([self.gradeLetterfromNumber(trial[i]) for i in range(3)])
+            return Tariff.forYear().gradesForPoints(int(self.getGrades()))
 
     def gradeCompare(self, other, warn=True):
         # self is Offer object containing the result ('got') grades
@@ -614,18 +827,15 @@ class Offer:
         #               3 = 1 below, 4 = >1 below
         #               5 = +1-1, 6 = other mixed
         #               7 = CHECK (where extra conditions applied), 8 = No Offer
+        state = self.compareGrades(other, warn)
+        logwrite('@result "' + self.getGradeEquivalent() + '" offer "' + other.getGradeEquivalent() +
+                 '" outcome code ' + str(state))
+        return state
 
-        # transition matrix for cases: g<o-1,g=o-1,g=o,g=o+1,g>o+1
-        # matrix index is therefore sign(g-o) * min(abs(g-o),2) + 2
-        # tmatrix[currentstate][case] = newstate
-        tmatrix = [ [4,3,0,1,2], [6,5,1,2,2], [6,6,2,2,2], [4,4,3,5,6],
-                    [4,4,4,6,6], [6,6,5,6,6], [6,6,6,6,6] ]
-        # define the sign function
-        sign = lambda x:(1,-1)[x<0]
-
-        # Get string of grades (even for points offers)
-        got = self.getGradeEquivalent()
-        offer = other.getGradeEquivalent()
+    def compareGrades(self, other, warn=True):
+        # gradeCompare without the logging - see gradeCompareBatch
+        got = self.gradenumbers
+        offer = other.gradenumbers
 
         # Handle special case
         if other.getGradeValue() == Offer.SPECIALCONDITIONS:
@@ -634,32 +844,64 @@ class Offer:
         #start comparison state machine
         state = Offer.MATCHED
         for i in range(min(len(offer), len(got))): # only consider as many grades as needed by the offer condition
-            try:
-                g = self.gradeLettertoNumber(got[i])
-                o = self.gradeLettertoNumber(offer[i])
-            except ValueError:
-                logwrite('#unrecognised grade: position ' + str(i) + ' result ' + got + ' offer ' + offer)
+            g = got[i]
+            o = offer[i]
+            if g < 0 or o < 0:
+                logwrite('#unrecognised grade: position ' + str(i) + ' result ' + self.getGradeEquivalent() +
+                         ' offer ' + other.getGradeEquivalent())
                 return Offer.CHECK
-            state = tmatrix[state][sign(g-o) * min(abs(g-o),2) + 2]
+            state = Offer.TRANSITIONS[state][max(-2, min(g-o, 2)) + 2]
             if state == 5 and self.isPointsOffer():
                 state = 0                       # up1dn1 equals met for a points offer
-        logwrite('@result "' + got + '" offer "' + offer + '" outcome code ' + str(state))
         # optional warning if seemingly met but more conditions left unchecked
         if warn and state in Offer.MET and len(offer) > len(got):
             state = Offer.CHECK
         return state
 
-    def gradeLettertoNumber(self, letter):
-        return 'EDCBA@'.index(letter)
-
-    def gradeLetterfromNumber(self, n):
-        return 'EDCBA@'[n]
+    @staticmethod
+    def gradeCompareBatch(results, offers, warn=True):
+        # Outcome codes as gradeCompare for each pair results[i], offers[i] (lists of Offer objects)
+        # With NumPy the transition table is applied to every pair at once, one grade position at a time
+        if NP is None or len(results) == 0:
+            return [r.compareGrades(o, warn) for r, o in zip(results, offers)]
+        # offers are interned so encode each distinct one once, then index the encodings
+        encodings = {}
+        rindex = [encodings.setdefault(id(r), (len(encodings), r))[0] for r in results]
+        oindex = [encodings.setdefault(id(o), (len(encodings), o))[0] for o in offers]
+        distinct = [offer for n, offer in sorted(encodings.values(), key=lambda x:x[0])]
+        width = max([len(offer.gradenumbers) for offer in distinct] + [1])
+        grades = NP.full((len(distinct), width), -1, dtype=NP.int16)
+        for n, offer in enumerate(distinct):
+            grades[n, :len(offer.gradenumbers)] = offer.gradenumbers
+        lengths = NP.array([len(offer.gradenumbers) for offer in distinct])
+        rindex = NP.array(rindex)
+        oindex = NP.array(oindex)
+        got = grades[rindex]
+        offer = grades[oindex]
+        gotlen = lengths[rindex]
+        offerlen = lengths[oindex]
+        compared = NP.arange(width)[NP.newaxis, :] < NP.minimum(gotlen, offerlen)[:, NP.newaxis]
+        # transition matrix index is sign(g-o) * min(abs(g-o),2) + 2
+        cases = NP.clip(got - offer, -2, 2) + 2
+        pointsresult = NP.array([offer.isPointsOffer() for offer in distinct])[rindex]
+        transitions = NP.array(Offer.TRANSITIONS, dtype=NP.int16)
+        state = NP.full(len(results), Offer.MATCHED, dtype=NP.int16)
+        for i in range(width):
+            newstate = transitions[state, cases[:, i]]
+            newstate[(newstate == 5) & pointsresult] = 0    # up1dn1 equals met for a points offer
+            state = NP.where(compared[:, i], newstate, state)
+        if warn:
+            state[NP.isin(state, Offer.MET) & (offerlen > gotlen)] = Offer.CHECK
+        unrecognised = (((got < 0) | (offer < 0)) & compared).any(axis=1)
+        special = NP.array([offer.getGradeValue() == Offer.SPECIALCONDITIONS for offer in distinct])[oindex]
+        state[unrecognised | special] = Offer.CHECK
+        return state.tolist()
 
-    def gradeNumbertoPoints(self, n):       # 2017 Tariff
-        return n*8 + 16
+    def gradeLettertoNumber(self, letter):
+        return Tariff.forYear().letterToNumber(letter)
 
     def gradeLettertoPoints(self, letter):
-        return self.gradeNumbertoPoints(self.gradeLettertoNumber(letter))
+        return Tariff.forYear().pointsForLetter(letter)
 
 #########################################################################################################
 #
@@ -679,6 +921,7 @@ class UniRecord():
         self.name = name
         self.outcomes = [0, 0, 0]   # unconditionals, conditionals, rejections
         self.offers = []            # list of offer objects
+        self.offercounts = collections.Counter()    # k=offer grade key, v=number of offers
 
     # Get / set methods
 
@@ -718,7 +961,9 @@ class UniRecord():
         return self.name == str(other)
 
     def addOffer(self, offerstring):
-        self.offers.append(Offer(offerstring))
+        offer = Offer.fromString(offerstring)
+        self.offers.append(offer)
+        self.offercounts[offer.getGrades()] += 1
 
     def getTotalOutcomes(self):
         return sum([self.outcomes[i] for i in range(3)])
@@ -728,11 +973,378 @@ class UniRecord():
 
     def getNumOffers(self, grades):
         if 'A*' in grades: grades = grades.replace('A*','@')
-        count = 0
-        for offer in self.offers:
-            if offer.getGrades() == grades:
-                count += 1
-        return count
+        return self.offercounts[grades]
+
+class OfferIndex():
+    # Conditional offers made to the cohort across all unis, courses and ASR dates, sorted by tariff
+    # points so range queries (eg for clearing: who made offers at or below N points) are a bisect
+
+    def __init__(self, studentmanager):
+        counts = {}     # k=(points, uni, course, grades), v=number of students given that offer
+        for student in studentmanager:
+            offers = set()
+            for thedate in studentmanager.getAllDatesSeen():
+                for choice in student.getChoices(thedate):
+                    if choice.getOutcome() == Outcome.C:
+                        value = choice.getOfferGradeValue()
+                        if value != Offer.SPECIALCONDITIONS:
+                            offers.add((value, choice.getUni(), choice.getCrsText(), choice.getOfferGrades(astar=True)))
+            for key in offers:
+                counts[key] = counts.get(key, 0) + 1
+        self.entries = sorted(counts.items())
+        self.points = [key[0] for key, count in self.entries]
+
+    def getNumEntries(self):
+        return len(self.entries)
+
+    def getOffersBetween(self, low, high):
+        # list of ((points, uni, course, grades), count) with low <= points <= high, lowest first
+        return self.entries[bisect.bisect_left(self.points, low):bisect.bisect_right(self.points, high)]
+
+    def getOffersDownFrom(self, points):
+        # generator of the entries with points at or below points, highest first - without copying the list
+        entries = self.entries
+        for i in range(bisect.bisect_right(self.points, points)-1, -1, -1):
+            yield entries[i]
+
+class TrendAggregates():
+    # Counts of choices by outcome for each ASR date, by uni and overall. Each date is counted once, when
+    # its ASR file is imported (or when it is first needed, for data saved before trends were kept), so
+    # the trend report never goes back over the history. Saved with the students.
+
+    OVERALL     = ''        # uni key for the totals over all unis
+    MEASURES    = ['Choices', 'Offers', 'Unconditional', 'Conditional', 'Interviews', 'Referrals',
+                   'Rejections', 'Withdrawals', 'Firm', 'Insurance', 'Declined']
+    KINDS       = { Outcome.U: 'Unconditional', Outcome.C: 'Conditional', Outcome.INV: 'Interviews',
+                    Outcome.REF: 'Referrals', Outcome.REJ: 'Rejections', Outcome.W: 'Withdrawals' }
+
+    def __init__(self):
+        self.bydate = {}    # k=ASR date, v=dict k=uni, v=Counter of measures
+
+    def hasDate(self, thedate):
+        return thedate in self.bydate
+
+    def addDate(self, studentmanager, thedate):
+        # count (or recount) the choices held for one ASR date
+        counts = {}
+        for student in studentmanager.getStudents():
+            for choice in student.getChoices(thedate):
+                uni = choice.getUni()
+                if uni not in counts:
+                    counts[uni] = collections.Counter()
+                counter = counts[uni]
+                counter['Choices'] += 1
+                kind = choice.getOutcome()
+                if kind in TrendAggregates.KINDS:
+                    counter[TrendAggregates.KINDS[kind]] += 1
+                if kind == Outcome.C or kind == Outcome.U:
+                    counter['Offers'] += 1
+                if choice.isFirm():
+                    counter['Firm'] += 1
+                if choice.isInsc():
+                    counter['Insurance'] += 1
+                if choice.isDeclined():
+                    counter['Declined'] += 1
+        counts[TrendAggregates.OVERALL] = sum(counts.values(), collections.Counter())
+        self.bydate[thedate] = counts
+
+    def getDates(self):
+        # oldest first
+        return sorted(self.bydate, key=lambda d:datetime.datetime.strptime(d,'%d%m%Y'))
+
+    def getUnis(self, thedate):
+        return sorted(uni for uni in self.bydate[thedate] if uni != TrendAggregates.OVERALL)
+
+    def getCount(self, thedate, uni, measure):
+        counts = self.bydate[thedate].get(uni)
+        return 0 if counts is None else counts[measure]
+
+class ChoiceTable():
+    # Every choice at every ASR date as one row, stored by column so an ad hoc question (ChoiceQuery) is a
+    # filter, group and aggregate over a few arrays rather than a new report class. Text columns hold codes
+    # into an ordered list of their values (dates oldest first, the rest alphabetical). Built when first
+    # asked for and dropped by StudentManager.dataChanged().
+
+    TEXT        = ['date', 'name', 'uni', 'course', 'outcome', 'grades']
+    NUMBERS     = ['offerpoints', 'predictedpoints', 'firm', 'insc', 'declined']
+    COLUMNS     = TEXT + NUMBERS
+    MISSING     = -1    # no offer, special conditions or no predictions - ignored by sum, mean, min and max
+    OUTCOMES    = { Outcome.C: 'C', Outcome.U: 'U', Outcome.W: 'W',
+                    Outcome.REJ: 'REJ', Outcome.INV: 'INV', Outcome.REF: 'REF' }
+
+    def __init__(self, studentmanager):
+        values = {column: [] for column in ChoiceTable.COLUMNS}
+        for student in studentmanager.getStudents():
+            predicted = student.getPredictionsAsOffer().getGradeValue() or ChoiceTable.MISSING
+            for thedate in studentmanager.getAllDatesSeen():
+                for choice in student.getChoices(thedate):
+                    points = choice.getOfferGradeValue()
+                    values['date'].append(thedate)
+                    values['name'].append(student.getName())
+                    values['uni'].append(choice.getUni())
+                    values['course'].append(choice.getCrsText())
+                    values['outcome'].append(ChoiceTable.OUTCOMES[choice.getOutcome()])
+                    values['grades'].append(choice.getOfferGrades(astar=True))
+                    values['offerpoints'].append(ChoiceTable.MISSING if points in (0, Offer.SPECIALCONDITIONS)
+                                                 else points)
+                    values['predictedpoints'].append(predicted)
+                    values['firm'].append(int(choice.isFirm()))
+                    values['insc'].append(int(choice.isInsc()))
+                    values['declined'].append(int(choice.isDeclined()))
+        self.numrows = len(values['date'])
+        self.currentdate = studentmanager.getCurrentDate() if studentmanager.getAllDatesSeen() else None
+        self.previousdate = studentmanager.getPreviousDate() if len(studentmanager.getAllDatesSeen()) > 1 else None
+        self.levels = {}    # k=text column, v=its values in order
+        self.columns = {}   # k=column, v=list (NumPy array if installed) of codes or numbers
+        for column in ChoiceTable.TEXT:
+            self.levels[column] = sorted(set(values[column]), key=self.getSortKey(column))
+            codes = {value: code for code, value in enumerate(self.levels[column])}
+            values[column] = [codes[value] for value in values[column]]
+        for column in ChoiceTable.COLUMNS:
+            self.columns[column] = values[column] if NP is None else NP.array(values[column], dtype=NP.int64)
+
+    def getSortKey(self, column):
+        if column == 'date':
+            return lambda d:datetime.datetime.strptime(d,'%d%m%Y')
+        return lambda v:(v.lower(), v)
+
+    def getNumRows(self):
+        return self.numrows
+
+    def getColumn(self, column):
+        return self.columns[column]
+
+    def getLevels(self, column):
+        return self.levels[column]
+
+    def query(self, query):
+        # query is a ChoiceQuery or command text: returns headings and a list of rows
+        if not isinstance(query, ChoiceQuery):
+            query = ChoiceQuery.parse(query)
+        return query.getHeadings(), list(query.run(self))
+
+class ChoiceQuery():
+    # A question about the ChoiceTable, made in Python or parsed from a command such as
+    #     count, mean(offerpoints) by uni, course where outcome=C,U and date=current
+    # Aggregates are count, sum(col), mean(col), min(col) and max(col). Conditions are col=a,b (any of),
+    # col!=a,b and, for numbers and dates, <, <=, > and >=. Text matches ignore case. Dates are ddmmyyyy,
+    # current or previous.
+
+    AGGREGATES  = ['count', 'sum', 'mean', 'min', 'max']
+    OPERATORS   = { '=':  lambda a, b: a == b, '!=': lambda a, b: a != b,
+                    '<':  lambda a, b: a < b,  '<=': lambda a, b: a <= b,
+                    '>':  lambda a, b: a > b,  '>=': lambda a, b: a >= b }
+    CONDITION   = re.compile(r'\s*(\w+)\s*(<=|>=|!=|=|<|>)\s*(.*?)\s*(?:\band\s*)?(?=\w+\s*(?:<=|>=|!=|=|<|>)|$)',
+                             re.IGNORECASE)
+
+    def __init__(self, aggregates=None, groupby=None, where=None):
+        self.aggregates = aggregates or [('count', None)]   # list of (aggregate, column or None for count)
+        self.groupby = groupby or []                        # list of columns
+        self.where = where or []                            # list of (column, operator, list of values)
+        for aggregate, column in self.aggregates:
+            if aggregate not in ChoiceQuery.AGGREGATES:
+                raise ValueError('unknown aggregate ' + aggregate + ' - use one of ' + ', '.join(ChoiceQuery.AGGREGATES))
+            if aggregate != 'count' and column not in ChoiceTable.NUMBERS:
+                raise ValueError(aggregate + ' needs a numeric column: ' + ', '.join(ChoiceTable.NUMBERS))
+        for column in self.groupby:
+            ChoiceQuery.checkColumn(column)
+        for column, operator, values in self.where:
+            ChoiceQuery.checkColumn(column)
+            if operator not in ChoiceQuery.OPERATORS:
+                raise ValueError('unknown comparison ' + operator)
+            if operator not in ('=', '!=') and (len(values) != 1 or column in ChoiceTable.TEXT and column != 'date'):
+                raise ValueError(operator + ' needs a single number or date')
+
+    @staticmethod
+    def checkColumn(column):
+        if column not in ChoiceTable.COLUMNS:
+            raise ValueError('unknown column ' + str(column) + ' - use one of ' + ', '.join(ChoiceTable.COLUMNS))
+
+    @staticmethod
+    def parse(text):
+        # raises ValueError with a message for the user if the command can't be understood
+        parts = re.split(r'\bwhere\b', text, maxsplit=1, flags=re.IGNORECASE)
+        conditions = parts[1] if len(parts) > 1 else ''
+        parts = re.split(r'\bby\b', parts[0], maxsplit=1, flags=re.IGNORECASE)
+        groups = parts[1] if len(parts) > 1 else ''
+        text = parts[0]
+        aggregates = []
+        for item in text.split(','):
+            item = item.strip().lower()
+            match = re.fullmatch(r'(\w+)\s*\(\s*(\w+)\s*\)', item)
+            if match:
+                aggregates.append((match.group(1), match.group(2)))
+            elif item:
+                aggregates.append((item, None))
+        groupby = [column.strip().lower() for column in groups.split(',') if column.strip()]
+        where = []
+        conditions = conditions.strip()
+        position = 0
+        while position < len(conditions):
+            match = ChoiceQuery.CONDITION.match(conditions, position)
+            if not match or match.end() == position:
+                raise ValueError('condition not understood: ' + conditions[position:])
+            where.append((match.group(1).lower(), match.group(2),
+                          [value.strip() for value in match.group(3).split(',')]))
+            position = match.end()
+        return ChoiceQuery(aggregates, groupby, where)
+
+    def getHeadings(self):
+        return self.groupby + [aggregate if column is None else aggregate + '(' + column + ')'
+                               for aggregate, column in self.aggregates]
+
+    def run(self, table):
+        # generator of result rows, one per group in column order (one row in all if not grouped)
+        selected = self.select(table)
+        if NP is None:
+            groups = self.aggregateSlowly(table, selected)
+        else:
+            groups = self.aggregateVectorised(table, selected)
+        if not self.groupby and not groups:
+            groups = [((), [0] + [None] * len(self.aggregates))]
+        for key, results in groups:
+            row = [table.getLevels(column)[value] if column in ChoiceTable.TEXT else value
+                   for column, value in zip(self.groupby, key)]
+            yield tuple(row + self.summarise(results))
+
+    def getTests(self, table):
+        # each condition as (column, operator, operands): codes for text columns, numbers otherwise
+        tests = []
+        for column, operator, values in self.where:
+            if column in ChoiceTable.NUMBERS:
+                try:
+                    tests.append((column, operator, [int(value) for value in values]))
+                except ValueError:
+                    raise ValueError(column + ' must be compared with whole numbers')
+            elif operator not in ('=', '!='):
+                # date order: compare codes with the position the date would take among the dates
+                key = table.getSortKey('date')
+                keys = [key(level) for level in table.getLevels('date')]
+                thedate = key(self.getDate(table, values[0]))
+                if operator in ('<', '>='):
+                    tests.append((column, operator, [bisect.bisect_left(keys, thedate)]))
+                else:
+                    tests.append((column, '<' if operator == '<=' else '>=', [bisect.bisect_right(keys, thedate)]))
+            else:
+                if column == 'date':
+                    wanted = {self.getDate(table, value) for value in values}
+                    match = lambda level:level in wanted
+                else:
+                    wanted = {value.lower() for value in values}
+                    match = lambda level:level.lower() in wanted
+                tests.append((column, operator,
+                              [code for code, level in enumerate(table.getLevels(column)) if match(level)]))
+        return tests
+
+    def getDate(self, table, value):
+        thedate = {'current': table.currentdate, 'previous': table.previousdate}.get(value.lower(), value)
+        try:
+            datetime.datetime.strptime(thedate or '', '%d%m%Y')
+        except ValueError:
+            raise ValueError('date ' + value + ' is not ddmmyyyy, current or previous')
+        return thedate
+
+    def select(self, table):
+        # row numbers (a NumPy array if installed) meeting every condition
+        tests = self.getTests(table)
+        if NP is None:
+            rows = range(table.getNumRows())
+            for column, operator, operands in tests:
+                values = table.getColumn(column)
+                if operator in ('=', '!='):
+                    wanted = set(operands)
+                    rows = [n for n in rows if (values[n] in wanted) == (operator == '=')]
+                else:
+                    compare = ChoiceQuery.OPERATORS[operator]
+                    rows = [n for n in rows if compare(values[n], operands[0])]
+            return list(rows)
+        mask = NP.ones(table.getNumRows(), dtype=bool)
+        for column, operator, operands in tests:
+            values = table.getColumn(column)
+            if operator in ('=', '!='):
+                mask &= NP.isin(values, operands, invert=(operator == '!='))
+            else:
+                mask &= ChoiceQuery.OPERATORS[operator](values, operands[0])
+        return NP.nonzero(mask)[0]
+
+    def aggregateSlowly(self, table, rows):
+        # list of (key, [count, then (total, valid count, min, max) per aggregate column]) in key order
+        groupcolumns = [table.getColumn(column) for column in self.groupby]
+        aggregatecolumns = [table.getColumn(column) if column else None for aggregate, column in self.aggregates]
+        groups = {}
+        for n in rows:
+            key = tuple([values[n] for values in groupcolumns])
+            if key not in groups:
+                groups[key] = [0] + [[0, 0, None, None] for column in aggregatecolumns]
+            results = groups[key]
+            results[0] += 1
+            for values, result in zip(aggregatecolumns, results[1:]):
+                if values is not None and values[n] != ChoiceTable.MISSING:
+                    value = values[n]
+                    result[0] += value
+                    result[1] += 1
+                    result[2] = value if result[2] is None else min(result[2], value)
+                    result[3] = value if result[3] is None else max(result[3], value)
+        return sorted(groups.items())
+
+    def aggregateVectorised(self, table, rows):
+        if len(rows) == 0:
+            return []
+        if self.groupby:
+            keys = NP.stack([table.getColumn(column)[rows] for column in self.groupby], axis=1)
+            keys, groupnumbers = NP.unique(keys, axis=0, return_inverse=True)
+            groupnumbers = groupnumbers.reshape(-1)
+        else:
+            keys = NP.zeros((1, 0), dtype=NP.int64)
+            groupnumbers = NP.zeros(len(rows), dtype=NP.intp)
+        numgroups = len(keys)
+        counts = NP.bincount(groupnumbers, minlength=numgroups)
+        columns = []
+        for aggregate, column in self.aggregates:
+            if column is None:
+                columns.append(None)
+                continue
+            values = table.getColumn(column)[rows]
+            valid = values != ChoiceTable.MISSING
+            validgroups = groupnumbers[valid]
+            values = values[valid]
+            lowest = NP.full(numgroups, NP.iinfo(NP.int64).max)
+            highest = NP.full(numgroups, NP.iinfo(NP.int64).min)
+            NP.minimum.at(lowest, validgroups, values)
+            NP.maximum.at(highest, validgroups, values)
+            columns.append((NP.bincount(validgroups, weights=values, minlength=numgroups).tolist(),
+                            NP.bincount(validgroups, minlength=numgroups).tolist(),
+                            lowest.tolist(), highest.tolist()))
+        groups = []
+        for g, key in enumerate(keys.tolist()):
+            results = [int(counts[g])]
+            for column in columns:
+                if column is None:
+                    results.append(None)
+                else:
+                    total, valid, lowest, highest = (part[g] for part in column)
+                    results.append([int(total), valid, lowest if valid else None, highest if valid else None])
+            groups.append((tuple(key), results))
+        return groups
+
+    def summarise(self, results):
+        # the figure for each aggregate from a group's accumulated results
+        count = results[0]
+        figures = []
+        for (aggregate, column), result in zip(self.aggregates, results[1:]):
+            if aggregate == 'count':
+                figures.append(count)
+            elif result is None or result[1] == 0:
+                figures.append('')
+            elif aggregate == 'sum':
+                figures.append(result[0])
+            elif aggregate == 'mean':
+                figures.append('{:.2f}'.format(result[0] / result[1]))
+            elif aggregate == 'min':
+                figures.append(result[2])
+            else:
+                figures.append(result[3])
+        return figures
 
 #########################################################################################################
 #
@@ -964,6 +1576,8 @@ class SIMSExtractDS(DataSource):
     DOBKEYS        = ['DOB', 'DATE OF BIRTH']
     PCODEKEYS      = ['POSTCODE', 'PCODE']
     EXAMNOKEYS     = ['EXAM NUMBER', 'EXAMNO', 'EXAM NO']
+    FUZZYSCORE     = 0.8    # siblings at one address score 0.6-0.75, eg SMITH John/SMITH Jane
+    FUZZYMARGIN    = 0.1    # and the best similar name must be clearly better than the runner-up
 
     def __init__(self, app):
         # user chooses sims report csv file
@@ -975,18 +1589,35 @@ class SIMSExtractDS(DataSource):
         super().__init__(app, chosenfile, 'chosen', None)
         self.d = {}             # temp dict to hold csv data
         self.headings = []      # list of headings which are keys to d
+        self.index = None       # blocking indexes over UCAS students - built once when headings are read
+        self.matches = []       # one match record per SIMS row for the match report
+        self.lineno = 1         # header is line 1
 
     def getDSfilelist(self):    # overridden to return only the chosen file
         return [self.file]
 
+    def getMatches(self):
+        return self.matches
+
     def processLine(self, line):
         if self.headings == []:      # first line; extract headings
             self.setHeadings(line)
+            self.index = StudentIndex(self.app.getStudentManager())
         else:
+            self.lineno += 1
             self.prepareRecord(line)
-            student = self.identifyStudent()
-            if student is None:
-                logwrite('ignoring student not found in UCAS: line begins ' + line[:20])
+            student, method, confidence, note = self.identifyStudent()
+            self.updateStudentRecord(student)
+            if student is not None:
+                self.index.reindexStudent(student)     # UPN may just have been set from this row
+            self.matches.append({'Line': self.lineno,
+                                 'SIMS Name': (self.getAnyAvailableSurname() or '') + ' ' +
+                                              (self.getAnyAvailableForename() or ''),
+                                 'UCAS Name': student.getName() if student else '',
+                                 'UCAS ID': student.getUcasID() if student else '',
+                                 'Method': method,
+                                 'Confidence': confidence,
+                                 'Note': note})
             return student
 
     def setHeadings(self, line):
@@ -1008,58 +1639,78 @@ class SIMSExtractDS(DataSource):
             self.d['DOB'] = datetime.datetime.strptime(self.d['DOB'],'%d %B %Y')
 
     def identifyStudent(self):
-        studentmanager = self.app.getStudentManager()
-        me = None
+        # Returns (student or None, linkage method, confidence, note) using the blocking indexes
         if 'UPN' in self.d:     # try finding a UPN match first
-            me = studentmanager.getStudentbyUPN(self.d['UPN'])
-        if not me:
-            # UCI ULN ExamNo may only be in results file and not loaded yet
-            # so try matching on dob/pcode which is loaded early as it comes from UCAS ASR
-            candidatesDOB = set([])     # may be >1 student with same DOB
-            candidatesPCD = set([])     # likewise postcode
-            if 'DOB' in self.d:
-                candidatesDOB = set(studentmanager.getStudentbyDOB(self.d['DOB']))
-            if 'POSTCODE' in self.d:
-                candidatesPCD = set(studentmanager.getStudentbyPostcode(self.d['POSTCODE']))
-            if len(candidatesDOB) + len(candidatesPCD) != 0:
-                candidates = candidatesDOB.intersection(candidatesPCD)  # anyone matching both DOB and postcode?
-                if len(candidates) == 1:      # one student matched both: must be the right one
-                    me = list(candidates)[0]
-                elif len(candidates) > 1:       # separate by using names ... full names as maybe twins!
-                    for s in candidates:
-                        me = self.matchByName(s)
-                        if me: break
-                elif len(candidates) == 0:
-                    # No candidate matches both; check if a name matches any of those with EITHER pcode or DOB match
-                    # If so, warn in case of dirty data in SIMS or ASR
-                    for s in candidatesDOB.union(candidatesPCD):
-                        me = self.matchByName(s)
-                        if me: break
-                    if me is not None:
-                        logwrite('found UCAS student with matching name ' + me.getName() +
-                                 ' but mismatch fields: SIMS import DOB ' + str(self.d['DOB']) +
-                                 ' Postcode ' + self.d['POSTCODE'] +
-                                 ', but UCAS DOB ' + me.getDOBstring('%d %m %Y') + ' Postcode ' + me.getPCode() )
-                        logwrite('Student was imported anyway; review postcode and DOB data in SIMS')
-        self.updateStudentRecord(me)
-        # finally check exam number, if provided, is unique
-        if me and ('EXAMNO' in self.d):
-            duplicates = studentmanager.getStudentbyExamNo(me.getExamNo())
-            if len(duplicates) > 1:
-                msg = ", ".join([s.getName() for s in duplicates])
-                logwrite('warning: duplicate exam numbers for: ' + msg)
-                logwrite('resolve and re-import')
-        return me
-
-    def matchByName(self, s):
-        forename_me = s.getForename1()
-        forename_DS = self.getAnyAvailableForename()
-        surname_me = s.getSurname()
-        surname_DS = self.getAnyAvailableSurname()
-        if surname_me == surname_DS and forename_me == forename_DS:
-            return s
-        else:
-            return None
+            me = self.index.getByUPN(self.d['UPN'])
+            if me:
+                return me, Linkage.UPN, Linkage.CONFIDENCE[Linkage.UPN], ''
+        # UCI ULN ExamNo may only be in results file and not loaded yet
+        # so try matching on dob/pcode which is loaded early as it comes from UCAS ASR
+        dob = self.d.get('DOB')
+        pcode = self.d.get('POSTCODE')
+        names = self.getAllAvailableNames()     # legal and preferred names if both given
+        exactnames = [StudentIndex.normaliseName(surname, forename) for surname, forename in names]
+        fullnames = [surname + ' ' + forename for surname, forename in names]
+        if dob is not None and pcode is not None:
+            candidates = self.index.getByDOBPostcode(dob, pcode)   # anyone matching both DOB and postcode?
+            if len(candidates) == 1:        # one student matched both: must be the right one
+                return candidates[0], Linkage.DOBPCODE, Linkage.CONFIDENCE[Linkage.DOBPCODE], ''
+            elif len(candidates) > 1:       # separate by using names ... full names as maybe twins!
+                for s in candidates:
+                    if any([s in self.index.getByName(name) for name in exactnames]):
+                        return s, Linkage.DOBPCODENAME, Linkage.CONFIDENCE[Linkage.DOBPCODENAME], ''
+                score, s = self.bestSimilarName(fullnames, candidates)
+                if s:
+                    return s, Linkage.DOBPCODEFUZZY, round(Linkage.CONFIDENCE[Linkage.DOBPCODEFUZZY]*score, 2), ''
+                return None, Linkage.UNMATCHED, 0.0, str(len(candidates)) + ' students share DOB and postcode'
+        # No candidate matches both; check if a name matches any of those with EITHER pcode or DOB match
+        # If so, note it in case of dirty data in SIMS or ASR
+        partial = self.index.getByDOB(dob) + self.index.getByPostcode(pcode)
+        simsdata = 'SIMS DOB ' + (dob.strftime('%d %m %Y') if dob else 'None') + ' Postcode ' + str(pcode)
+        for me in partial:
+            if any([me in self.index.getByName(name) for name in exactnames]):
+                note = simsdata + ' but UCAS DOB ' + me.getDOBstring('%d %m %Y') + ' Postcode ' + me.getPCode() + \
+                       ' - review postcode and DOB data in SIMS'
+                return me, Linkage.PARTIALNAME, Linkage.CONFIDENCE[Linkage.PARTIALNAME], note
+        # a similar name sharing just one of DOB and postcode is as likely to be a sibling - not linked,
+        # but listed so the user can check
+        ranked = self.rankSimilarNames(fullnames, partial)
+        if ranked:
+            score, me = ranked[0]
+            note = 'possible match ' + me.getName() + ' (' + str(round(score, 2)) + ') with UCAS DOB ' + \
+                   me.getDOBstring('%d %m %Y') + ' Postcode ' + me.getPCode() + ', ' + simsdata + \
+                   ' - check and fix the data to link'
+            logwrite('SIMS line ' + str(self.lineno) + ' not linked: ' + note)
+            return None, Linkage.UNMATCHED, 0.0, note
+        # Not linked: suggest the closest UCAS names to help a manual fix
+        suggestions = {}
+        for name in fullnames:
+            for score, s in self.index.getBySimilarName(name):
+                suggestions[s] = max(score, suggestions.get(s, 0))
+        note = ' / '.join([s.getName() + ' (' + str(round(score, 2)) + ')'
+                           for s, score in sorted(suggestions.items(), key=lambda x:x[1], reverse=True)[:3]])
+        return None, Linkage.UNMATCHED, 0.0, ('closest UCAS names: ' + note) if note else ''
+
+    def rankSimilarNames(self, fullnames, candidates):
+        # (score, student) from a small candidate block by trigram similarity, best first
+        ranked = []
+        for s in {id(s): s for s in candidates}.values():    # a student can be in both DOB and postcode blocks
+            score = max([NameMatcher.similarity(name, s.getName()) for name in fullnames] + [0])
+            if score >= NameMatcher.MINSCORE:
+                ranked.append((score, s))
+        return sorted(ranked, key=lambda x:x[0], reverse=True)
+
+    def bestSimilarName(self, fullnames, candidates):
+        # (score, student) for a name that is both close and clearly the best of the block, or (0, None)
+        ranked = self.rankSimilarNames(fullnames, candidates)
+        if ranked and ranked[0][0] >= SIMSExtractDS.FUZZYSCORE and \
+                (len(ranked) == 1 or ranked[0][0] - ranked[1][0] >= SIMSExtractDS.FUZZYMARGIN):
+            return ranked[0]
+        return (0, None)
+
+    def getDuplicateExamNumbers(self):
+        # called once after the whole file is matched rather than after each row
+        return self.index.getDuplicateExamNumbers()
 
     def updateStudentRecord(self, student):
         if student is not None:
@@ -1089,6 +1740,12 @@ class SIMSExtractDS(DataSource):
             fieldnumber = availableforenamefields.index(True)
             return self.d[SIMSExtractDS.FORENAMEFIELDS[fieldnumber]]
 
+    def getAllAvailableNames(self):
+        # (surname, forename) for every available name pair e.g. legal and preferred
+        surname = self.getAnyAvailableSurname() or ''
+        return [(surname, self.d[field]) for field in SIMSExtractDS.FORENAMEFIELDS if field in self.d] \
+               or [(surname, '')]
+
 #########################################################################################################
 #
 #  CLASS ASRFILE
@@ -1201,6 +1858,12 @@ class StudentManager():
         self.app = app
         self.students = []      # list of student objects
         self.withDates = []     # list of ASR dates used to assemble students list
+        self.evaluations = {}   # k=ASR date, v=CohortEvaluation - cleared whenever data changes
+        self.offerindex = None  # OfferIndex over all dates - cleared whenever data changes
+        self.choicetable = None # ChoiceTable over all dates - cleared whenever data changes
+        self.searchindex = SearchIndex()    # kept across data changes - updated as students, results or dates are added
+        self.version = 0        # bumped whenever data changes - reports are cached against it
+        self.trends = TrendAggregates()     # counts by ASR date - kept across data changes and saved
 
     def __iter__(self):
         self.ptr = -1
@@ -1258,6 +1921,51 @@ class StudentManager():
                 insertpoint += 1  # in case of adding at end of list
             self.withDates.insert(insertpoint, thedate)
 
+    def getEvaluation(self, thedate=None):
+        # firm/insc offers, met status and risk for the whole cohort, built once per date
+        if thedate is None:
+            thedate = self.getCurrentDate()
+        if thedate not in self.evaluations:
+            self.evaluations[thedate] = CohortEvaluation(self, thedate)
+        return self.evaluations[thedate]
+
+    def getTrends(self):
+        # count any dates that were loaded without trends (data saved before they were kept)
+        for thedate in self.getAllDatesSeen():
+            if not self.trends.hasDate(thedate):
+                self.trends.addDate(self, thedate)
+        return self.trends
+
+    def updateTrends(self, thedate):
+        # call once the choices for a newly imported ASR date are all in
+        self.trends.addDate(self, thedate)
+
+    def getOfferIndex(self):
+        if self.offerindex is None:
+            self.offerindex = OfferIndex(self)
+        return self.offerindex
+
+    def getSearchIndex(self):
+        return self.searchindex.update(self, self.app.getSubjectManager())
+
+    def getChoiceTable(self):
+        if self.choicetable is None:
+            self.choicetable = ChoiceTable(self)
+        return self.choicetable
+
+    def dataChanged(self):
+        # call after any import that changes student data so evaluations and reports are rebuilt
+        self.evaluations = {}
+        self.offerindex = None
+        self.choicetable = None
+        self.version += 1
+
+    def getVersion(self):
+        return self.version
+
+    def getStudents(self):
+        return self.students
+
     def getStudentbyPosition(self,n):
         try:
             s = self.students[n]
@@ -1334,6 +2042,11 @@ class StudentManager():
             self.app.validateLicence(pickle.load(f),'student datafile '+pklfile)
             self.withDates = pickle.load(f)
             self.students = pickle.load(f)
+            try:
+                self.trends = pickle.load(f)
+            except EOFError:    # saved before trends were kept - they're counted when first needed
+                self.trends = TrendAggregates()
+        self.dataChanged()
         logwrite('success!')
         return True
 
@@ -1391,6 +2104,7 @@ class StudentManager():
             pickle.dump(self.app.getLicenseToken(), f)
             pickle.dump(self.withDates, f)
             pickle.dump(self.students, f)
+            pickle.dump(self.getTrends(), f)
         return pklfile
 
     def getPickleFileName(self):
@@ -1400,6 +2114,612 @@ class StudentManager():
         except:
             return None
 
+#########################################################################################################
+#
+#  CLASS STUDENTINDEX + linkage methods for matching other data sources to UCAS students
+#
+#########################################################################################################
+
+class Linkage:
+    UPN             = 'UPN'
+    DOBPCODE        = 'DOB+Postcode'
+    DOBPCODENAME    = 'DOB+Postcode+Name'
+    PARTIALNAME     = 'DOB or Postcode+Name'
+    DOBPCODEFUZZY   = 'DOB+Postcode+Similar Name'
+    UNMATCHED       = 'Unmatched'
+    # similar name methods are scaled by the name similarity score
+    CONFIDENCE      = { UPN: 1.0, DOBPCODE: 0.95, DOBPCODENAME: 0.9, PARTIALNAME: 0.6,
+                        DOBPCODEFUZZY: 0.85, UNMATCHED: 0.0 }
+
+class NameMatcher():
+    # Approximate name lookup - character trigram inverted index with Dice similarity scoring
+    # Copes with hyphenated surnames, accents and word order that defeat exact/prefix comparison
+
+    MINSCORE = 0.6
+
+    def __init__(self):
+        self.postings = {}      # k=trigram, v=set of keys
+        self.grams = {}         # k=key, v=set of trigrams of the name indexed under that key
+        self.items = {}         # k=key, v=list of objects with that name
+
+    @staticmethod
+    def normalise(name):
+        # strip accents, treat hyphens and apostrophes as word breaks, upper case
+        name = ''.join([c for c in unicodedata.normalize('NFKD', name) if not unicodedata.combining(c)])
+        return ' '.join(''.join([c if c.isalpha() else ' ' for c in name.upper()]).split())
+
+    @staticmethod
+    def trigrams(name):
+        # each word padded so that word starts weigh more and word order doesn't matter
+        return {('  ' + w + ' ')[i:i+3] for w in NameMatcher.normalise(name).split() for i in range(len(w)+1)}
+
+    @staticmethod
+    def similarity(a, b):
+        ga, gb = NameMatcher.trigrams(a), NameMatcher.trigrams(b)
+        if not ga or not gb:
+            return 0
+        return 2 * len(ga & gb) / (len(ga) + len(gb))
+
+    def add(self, name, item, key=None):
+        # key defaults to the normalised name - Student NAMEHASH can be used instead
+        if key is None:
+            key = NameMatcher.normalise(name)
+        if key not in self.grams:
+            self.grams[key] = NameMatcher.trigrams(name)
+            for g in self.grams[key]:
+                self.postings.setdefault(g, set()).add(key)
+        self.items.setdefault(key, []).append(item)
+
+    def lookup(self, name, limit=5, minscore=MINSCORE):
+        # ranked list of (score, item)
+        # a name scoring >= minscore must share at least 'need' trigrams with the target, so it must
+        # appear in one of the rarest len-need+1 postings: only those candidates are scored
+        target = NameMatcher.trigrams(name)
+        if not target:
+            return []
+        need = max(1, math.ceil(minscore * len(target) / (2 - minscore) - 1e-9))
+        grams = sorted(target, key=lambda g:len(self.postings.get(g, ())))
+        candidates = set()
+        for g in grams[:len(grams)-need+1]:
+            candidates.update(self.postings.get(g, ()))
+        scored = [(2 * len(target & self.grams[key]) / (len(target) + len(self.grams[key])), key)
+                  for key in candidates]
+        return [(score, item) for score, key in heapq.nlargest(limit, scored)
+                if score >= minscore for item in self.items[key]]
+
+class StudentIndex():
+    # Blocking indexes built once per import so each incoming record is matched with dict lookups
+    # rather than scanning every student for every field
+
+    def __init__(self, studentmanager):
+        self.students = []
+        self.byUPN = {}
+        self.upns = {}              # k=id(student), v=UPN it is held under in byUPN
+        self.byDOB = {}             # k=DOB datetime, v=list of students
+        self.byPostcode = {}
+        self.byDOBPostcode = {}     # k=(DOB, postcode)
+        self.byName = {}            # k=normalised 'SURNAME FORENAME'
+        self.names = NameMatcher()  # approximate names keyed by NAMEHASH
+        for s in studentmanager:
+            self.addStudent(s)
+
+    @staticmethod
+    def normaliseName(surname, forename):
+        # upper case, single spaces and first forename only, as held on Student
+        surname = ' '.join((surname or '').upper().split())
+        forename = (forename or '').upper().split()
+        return surname + ' ' + (forename[0] if forename else '')
+
+    def addStudent(self, s):
+        self.students.append(s)
+        self.indexUPN(s)
+        self.byDOB.setdefault(s.getDOB(), []).append(s)
+        self.byPostcode.setdefault(s.getPCode(), []).append(s)
+        self.byDOBPostcode.setdefault((s.getDOB(), s.getPCode()), []).append(s)
+        self.byName.setdefault(self.normaliseName(s.getSurname(), s.getForename1()), []).append(s)
+        self.names.add(s.getName(), s, s.getID('NAMEHASH'))
+
+    def reindexStudent(self, s):
+        # only the IDs can change during an import - DOB, postcode and name come from the ASR
+        upn = self.upns.pop(id(s), None)
+        if upn is not None and self.byUPN.get(upn) is s:
+            del self.byUPN[upn]
+        self.indexUPN(s)
+
+    def indexUPN(self, s):
+        if s.getUPN() != MISSING:
+            self.byUPN[s.getUPN()] = s
+            self.upns[id(s)] = s.getUPN()
+
+    def getByUPN(self, upn):
+        return self.byUPN.get(upn)
+
+    def getByDOB(self, dob):
+        return self.byDOB.get(dob, [])
+
+    def getByPostcode(self, pcode):
+        return self.byPostcode.get(pcode, [])
+
+    def getByDOBPostcode(self, dob, pcode):
+        return self.byDOBPostcode.get((dob, pcode), [])
+
+    def getByName(self, name):
+        return self.byName.get(name, [])
+
+    def getBySimilarName(self, name, limit=5):
+        return self.names.lookup(name, limit)
+
+    def getDuplicateExamNumbers(self):
+        # list of lists of students sharing an exam number
+        byexamno = {}
+        for s in self.students:
+            if s.getExamNo() != MISSING:
+                byexamno.setdefault(s.getExamNo(), []).append(s)
+        return [students for examno, students in sorted(byexamno.items()) if len(students) > 1]
+
+#########################################################################################################
+#
+#  CLASS COHORTEVALUATION - firm/insurance offers and their status for every student at one ASR date
+#
+#########################################################################################################
+
+class CohortEvaluation():
+    # Built in one pass over the cohort by StudentManager.getEvaluation and shared by the reports and
+    # the search table. Each attribute below is a list with one entry per student, in student order.
+
+    NOOFFERS    = 'No offers'
+    FIRM        = 'Firm'
+    INSC        = 'Insc'
+    UNMET       = 'Unmet'
+    CHECK       = 'CHECK'
+
+    HIGH        = 'HIGH'
+    MEDIUM      = 'MEDIUM'
+    LOW         = 'LOW'
+    SPECIAL     = ' (special conditions)'
+
+    def __init__(self, studentmanager, thedate):
+        self.date = thedate
+        self.students = [student for student in studentmanager]
+        self.firms = []             # Choice or None
+        self.inscs = []             # Choice or None
+        self.mainchoices = []       # firm, or else choice #1, or None if no choices
+        self.mainnotes = []         # ' (CF)' or ' (#1)' to show which
+        self.possibleoffers = []
+        self.firmpoints = []        # tariff value of firm/insc offer, 0 if none
+        self.inscpoints = []
+        self.results = []           # results and predictions as Offer objects
+        self.predictions = []
+        for student in self.students:
+            choices = student.getChoices(thedate)
+            firm = student.getFirm(thedate)
+            insc = student.getInsc(thedate)
+            self.firms.append(firm)
+            self.inscs.append(insc)
+            if firm:
+                self.mainchoices.append(firm)
+                self.mainnotes.append(' (CF)')
+            else:
+                self.mainchoices.append(choices[0] if choices else None)
+                self.mainnotes.append(' (#1)')
+            self.possibleoffers.append(student.getPossibleOffers(thedate))
+            self.firmpoints.append(firm.getOffer().getGradeValue() if firm else 0)
+            self.inscpoints.append(insc.getOffer().getGradeValue() if insc else 0)
+            self.results.append(student.getResultsAsOffer())
+            self.predictions.append(student.getPredictionsAsOffer())
+        # outcome codes (Offer.MATCHED etc) comparing results with firm, insc and predictions
+        self.firmcompare = self.compareOffers(self.firms)
+        self.insccompare = self.compareOffers(self.inscs)
+        self.predcompare = Offer.gradeCompareBatch(self.results, self.predictions, False)
+        self.destinations = [self.getDestination(n) for n in range(len(self.students))]
+        # risk works off actual results once any are in, otherwise predictions
+        self.usingresults = any([len(student.getResults()) > 0 for student in self.students])
+        self.riskgrades = []        # the results or predictions used to assess risk
+        self.riskpoints = []
+        self.risks = []             # '' if not at risk
+        for n, student in enumerate(self.students):
+            self.setRisk(n, student)
+
+    def compareOffers(self, choices):
+        # outcome code per student, NOOFFER where there is no choice
+        withchoice = [n for n, choice in enumerate(choices) if choice is not None]
+        outcomes = [Offer.NOOFFER] * len(choices)
+        compared = Offer.gradeCompareBatch([self.results[n] for n in withchoice],
+                                           [choices[n].getOffer() for n in withchoice])
+        for n, outcome in zip(withchoice, compared):
+            outcomes[n] = outcome
+        return outcomes
+
+    def getDestination(self, n):
+        if self.firms[n] is None:
+            return CohortEvaluation.NOOFFERS
+        elif self.firmcompare[n] in Offer.MET:
+            return CohortEvaluation.FIRM
+        elif self.inscs[n] and self.insccompare[n] in Offer.MET:
+            return CohortEvaluation.INSC
+        elif self.firmcompare[n] in Offer.UNMET and self.inscs[n] and self.insccompare[n] in Offer.UNMET:
+            return CohortEvaluation.UNMET
+        else:
+            return CohortEvaluation.CHECK
+
+    def setRisk(self, n, student):
+        firm = self.firms[n]
+        insc = self.inscs[n]
+        fv = self.firmpoints[n]
+        if firm and firm.getOutcome() == Outcome.U:
+            fv = 0
+        iv = self.inscpoints[n]
+        if self.usingresults:
+            pg = self.results[n].getGradeEquivalent(astar=True)
+            pv = self.results[n].getGradeValue()
+        else:
+            count = 3 # number of predicted grades to consider as counting
+            if firm: count = max(firm.getOffer().numGrades(), count)
+            if insc: count = max(insc.getOffer().numGrades(), count)
+            pg = student.getPredictedGradeString(count)
+            pv = Offer.fromString(pg).getGradeValue()
+        # at risk are:
+        # students with no firm
+        # students with a firm offer > predictions
+        # students with a firm = predictions and insc >= predictions
+        # students with a firm = predictions and no insc
+        risk = ''
+        if firm is None: risk = CohortEvaluation.HIGH
+        if fv > pv:
+            risk = CohortEvaluation.HIGH
+            if fv == Offer.SPECIALCONDITIONS: risk += CohortEvaluation.SPECIAL
+            if insc:
+                if iv == pv:
+                    if not self.usingresults:
+                        risk = CohortEvaluation.MEDIUM
+                    elif insc.getOffer().getGrades() != pg:
+                        risk = CohortEvaluation.LOW
+                    else:   # the HIGH can become none as they've got their insc
+                        risk = ''
+                elif iv < pv:
+                    if not self.usingresults:
+                        risk = CohortEvaluation.LOW
+                    else:
+                        risk = ''   # got insc
+        if fv > 0 and fv == pv and not self.usingresults:
+            if iv >= pv or insc is None:
+                risk = CohortEvaluation.MEDIUM
+                if iv == Offer.SPECIALCONDITIONS: risk += CohortEvaluation.SPECIAL
+            elif iv == pv - 1:
+                risk = CohortEvaluation.LOW
+            # else FV=PV and IV at least 2 below PV so no risk
+        self.riskgrades.append(pg)
+        self.riskpoints.append(pv)
+        self.risks.append(risk)
+
+    def getDate(self):
+        return self.date
+
+    def getNumStudents(self):
+        return len(self.students)
+
+    def isUsingResults(self):
+        return self.usingresults
+
+#########################################################################################################
+#
+#  CLASS ADMISSIONSIMULATOR - Monte Carlo estimate of the chance each student meets firm or insurance
+#
+#########################################################################################################
+
+class AdmissionSimulator():
+    # Each predicted grade is treated as a distribution of result - prediction differences (in grades),
+    # calibrated per subject from students with both a result and a prediction, falling back to all
+    # subjects pooled and then to DEFAULTDIFFS. Results are sampled for every student and checked
+    # against their firm and insurance offers as the at risk report does: special conditions can't be met.
+
+    DEFAULTDIFFS    = {-3: 3, -2: 12, -1: 35, 0: 40, 1: 10}   # used until results are in: mostly accurate or 1 high
+    MAXDIFF         = 3         # larger differences are counted as this
+    MINCALIBRATION  = 30        # fewer result/prediction pairs than this and the subject uses the pooled figures
+    SAMPLES         = 10000
+    SLOWSAMPLES     = 1000      # default without NumPy
+    SEED            = 2017      # fixed so reports are repeatable
+    LEVELS          = 65536     # NumPy draws index a table of this many equally likely results
+    CHUNKCELLS      = 1 << 24   # sampled grades held in memory at once (students x samples x grades)
+    U               = -1        # grade number for U; E=0 .. A*=5 as Tariff
+
+    def __init__(self, samples=None, seed=SEED):
+        if samples is None:
+            samples = AdmissionSimulator.SAMPLES if NP is not None else AdmissionSimulator.SLOWSAMPLES
+        self.samples = samples
+        self.seed = seed
+        self.pooled = dict(AdmissionSimulator.DEFAULTDIFFS)
+        self.subjects = {}      # k=SIMS name, v=dict of diff: count
+        tariff = Tariff.forYear()
+        self.gradepoints = [0] + [tariff.pointsForLetter(g) for g in Tariff.GRADES]  # indexed by grade number + 1
+
+    def calibrate(self, studentmanager, subjectmanager):
+        # count result - prediction differences by subject, as the by subject report does
+        subjects = {}
+        for student in studentmanager:
+            predictions = student.getPredictions()
+            for code, result in student.getResults().items():
+                subject = subjectmanager.getSubjectbyUnitCode(code)
+                if subject is None or subject.getSIMSName() not in predictions:
+                    continue
+                got = self.gradeNumber(result.getGrade())
+                predicted = self.gradeNumber(predictions[subject.getSIMSName()])
+                if got is None or predicted is None:
+                    continue
+                diff = max(-AdmissionSimulator.MAXDIFF, min(got - predicted, AdmissionSimulator.MAXDIFF))
+                counts = subjects.setdefault(subject.getSIMSName(), {})
+                counts[diff] = counts.get(diff, 0) + 1
+        pooled = {}
+        for counts in subjects.values():
+            for diff, count in counts.items():
+                pooled[diff] = pooled.get(diff, 0) + count
+        if sum(pooled.values()) >= AdmissionSimulator.MINCALIBRATION:
+            self.pooled = pooled
+        self.subjects = {simsname: counts for simsname, counts in subjects.items()
+                         if sum(counts.values()) >= AdmissionSimulator.MINCALIBRATION}
+        logwrite('@admission simulator calibrated from ' + str(sum(pooled.values())) + ' results, ' +
+                 str(len(self.subjects)) + ' subjects with their own figures')
+        return self
+
+    def gradeNumber(self, grade):
+        if grade == 'U':
+            return AdmissionSimulator.U
+        grade = grade.replace('A*', '@')
+        if len(grade) != 1 or grade not in Tariff.GRADES:
+            return None
+        return Tariff.GRADES.index(grade)
+
+    def getDistribution(self, simsname):
+        return self.subjects.get(simsname, self.pooled)
+
+    def getPredictedGrades(self, student):
+        # (grade number, SIMS name) for each prediction, best grade first
+        grades = [(self.gradeNumber(grade), simsname) for simsname, grade in student.getPredictions().items()]
+        return sorted([g for g in grades if g[0] is not None], key=lambda g:-g[0])
+
+    def getRequirement(self, choice):
+        # None if the offer can't be met, else (points needed, grade numbers needed best first)
+        if choice is None:
+            return None
+        offer = choice.getOffer()
+        if offer.getGradeValue() == Offer.SPECIALCONDITIONS:
+            return None
+        if offer.isPointsOffer():
+            return (offer.getGradeValue(), ())
+        return (0, tuple(sorted(offer.gradenumbers, reverse=True)))
+
+    def simulate(self, cohort):
+        # returns lists of P(firm met), P(insc met and firm not) per student in the cohort evaluation
+        predicted = [self.getPredictedGrades(student) for student in cohort.students]
+        firms = [self.getRequirement(choice) for choice in cohort.firms]
+        inscs = [self.getRequirement(choice) for choice in cohort.inscs]
+        if NP is None:
+            return self.simulateSlowly(predicted, firms, inscs)
+        return self.simulateVectorised(predicted, firms, inscs)
+
+    def simulateSlowly(self, predicted, firms, inscs):
+        # pure Python version of simulateVectorised for when NumPy is not installed
+        rng = random.Random(self.seed)
+        distributions = {}
+        pfirm = []
+        pinsc = []
+        for grades, firm, insc in zip(predicted, firms, inscs):
+            samplers = []
+            for g, simsname in grades:
+                if simsname not in distributions:
+                    counts = self.getDistribution(simsname)
+                    diffs = sorted(counts)
+                    distributions[simsname] = (diffs, [counts[d] for d in diffs])
+                samplers.append((g, distributions[simsname]))
+            firmcount = 0
+            insccount = 0
+            for i in range(self.samples):
+                sample = sorted([max(AdmissionSimulator.U, min(g + rng.choices(diffs, weights)[0], 5))
+                                 for g, (diffs, weights) in samplers], reverse=True)
+                if self.meets(sample, firm):
+                    firmcount += 1
+                elif self.meets(sample, insc):
+                    insccount += 1
+            pfirm.append(firmcount / self.samples)
+            pinsc.append(insccount / self.samples)
+        return pfirm, pinsc
+
+    def meets(self, sample, requirement):
+        if requirement is None:
+            return False
+        points, needed = requirement
+        if len(needed) > len(sample):
+            return False
+        if sum([self.gradepoints[g + 1] for g in sample[:3]]) < points:
+            return False
+        return all([g >= n for g, n in zip(sample, needed)])
+
+    def simulateVectorised(self, predicted, firms, inscs):
+        rng = NP.random.default_rng(self.seed)
+        # lookup table of sampled grades: row (distribution * 7 + predicted grade + 1) holds LEVELS
+        # equally likely results, so indexing it with uniform draws samples that distribution
+        simsnames = sorted(self.subjects)
+        distributions = [self.pooled] + [self.subjects[s] for s in simsnames]
+        tablerow = {simsname: n + 1 for n, simsname in enumerate(simsnames)}
+        table = NP.concatenate([self.getTable(counts) for counts in distributions])
+        pfirm = NP.zeros(len(predicted))
+        pinsc = NP.zeros(len(predicted))
+        # students with the same number of predictions are simulated together, in chunks
+        bylength = {}
+        for n, grades in enumerate(predicted):
+            bylength.setdefault(len(grades), []).append(n)
+        for k, members in sorted(bylength.items()):
+            chunk = max(1, AdmissionSimulator.CHUNKCELLS // (self.samples * max(k, 1)))
+            for start in range(0, len(members), chunk):
+                rows = members[start:start+chunk]
+                # sample[j] is the (j+1)th best sampled grade, students x samples
+                sample = []
+                for j in range(k):
+                    offsets = NP.array([(tablerow.get(predicted[n][j][1], 0) * 7 + predicted[n][j][0] + 1) *
+                                        AdmissionSimulator.LEVELS for n in rows], dtype=NP.uint32)
+                    draws = rng.integers(0, AdmissionSimulator.LEVELS, size=(len(rows), self.samples), dtype=NP.uint16)
+                    index = draws.astype(NP.uint32)
+                    index += offsets[:, NP.newaxis]
+                    sample.append(NP.take(table, index))
+                self.sortDescending(sample)
+                firmmet = self.meetsVectorised(sample, [firms[n] for n in rows])
+                inscmet = self.meetsVectorised(sample, [inscs[n] for n in rows]) & ~firmmet
+                pfirm[rows] = NP.count_nonzero(firmmet, axis=1) / self.samples
+                pinsc[rows] = NP.count_nonzero(inscmet, axis=1) / self.samples
+        return pfirm.tolist(), pinsc.tolist()
+
+    def getTable(self, counts):
+        # 7 rows (predicted U, E .. A*) of LEVELS results in proportion to counts
+        diffs = sorted(counts)
+        cumulative = NP.cumsum([counts[d] for d in diffs]) / sum(counts.values())
+        levels = (NP.arange(AdmissionSimulator.LEVELS) + 0.5) / AdmissionSimulator.LEVELS
+        sampled = NP.array(diffs)[NP.minimum(NP.searchsorted(cumulative, levels), len(diffs) - 1)]
+        return NP.concatenate([NP.clip(g + sampled, AdmissionSimulator.U, 5).astype(NP.int8)
+                               for g in range(AdmissionSimulator.U, 6)])
+
+    def sortDescending(self, sample):
+        # insertion sort network across the list of arrays - a few grades per student so this is quick
+        for i in range(1, len(sample)):
+            for j in range(i, 0, -1):
+                high = NP.maximum(sample[j-1], sample[j])
+                NP.minimum(sample[j-1], sample[j], out=sample[j])
+                sample[j-1] = high
+
+    def meetsVectorised(self, sample, requirements):
+        # students x samples array of whether the sampled grades meet each student's requirement
+        met = NP.array([requirement is not None and len(requirement[1]) <= len(sample)
+                        for requirement in requirements])[:, NP.newaxis].repeat(self.samples, axis=1)
+        requirements = [requirement if requirement is not None else (0, ()) for requirement in requirements]
+        needpoints = NP.array([points for points, needed in requirements])
+        # only work on the students with something to check at each step
+        rows = NP.nonzero(needpoints)[0]
+        if len(rows):
+            gradepoints = NP.array(self.gradepoints, dtype=NP.int16)
+            points = NP.zeros((len(rows), self.samples), dtype=NP.int16)
+            for grades in sample[:3]:
+                points += gradepoints[grades[rows] + 1]
+            met[rows] &= points >= needpoints[rows, NP.newaxis]
+        for j in range(len(sample)):
+            needed = NP.array([needed[j] if j < len(needed) else AdmissionSimulator.U
+                               for points, needed in requirements], dtype=NP.int8)
+            rows = NP.nonzero(needed > AdmissionSimulator.U)[0]
+            if len(rows):
+                met[rows] &= sample[j][rows] >= needed[rows, NP.newaxis]
+        return met
+
+#########################################################################################################
+#
+#  CLASS SUBJECTANALYTICS - results against predictions by subject for the whole cohort
+#
+#########################################################################################################
+
+class SubjectAnalytics():
+    # Every result in a mapped subject is held as three parallel columns of small ints - subject number,
+    # result grade and predicted grade - so the figures by subject are a few bincounts over the cohort
+    # rather than a loop per student. Residual is result minus prediction in grades (positive: under-predicted).
+
+    GRADES          = ['U', 'E', 'D', 'C', 'B', 'A', 'A*']
+    NUMBERS         = {grade: number for number, grade in enumerate(GRADES)}
+    OTHER           = len(GRADES)       # result that isn't a grade (eg X for absent)
+    BINS            = OTHER + 1         # histogram columns per subject
+    NOPREDICTION    = -1                # no usable prediction so no residual
+
+    def __init__(self, subjectmanager):
+        self.subjects = [subject for subject in subjectmanager.getSubjects() if subject.getSIMSName()]
+        self.numbers = {subject.getUnitCode(): n for n, subject in enumerate(self.subjects)}
+        self.subjectcol = []
+        self.resultcol = []
+        self.predictioncol = []
+
+    def addStudent(self, student):
+        results = student.getResults()
+        predictions = student.getPredictions()
+        for code, result in results.items():
+            n = self.numbers.get(code)
+            if n is None:
+                logwrite('code '+str(code)+' not in '+str(results)+' for '+student.getName())
+                continue
+            grade = SubjectAnalytics.NUMBERS.get(result.getGrade(), SubjectAnalytics.OTHER)
+            predicted = predictions.get(self.subjects[n].getSIMSName())     # None if no prediction (retake?)
+            if predicted is None or grade == SubjectAnalytics.OTHER:
+                predicted = SubjectAnalytics.NOPREDICTION
+            elif predicted in SubjectAnalytics.NUMBERS:
+                predicted = SubjectAnalytics.NUMBERS[predicted]
+            else:
+                logwrite('grade '+predicted+' predicted for '+student.getName()+' not a grade!')
+                predicted = SubjectAnalytics.NOPREDICTION
+            self.subjectcol.append(n)
+            self.resultcol.append(grade)
+            self.predictioncol.append(predicted)
+
+    def getSubjects(self):
+        return self.subjects
+
+    def calculate(self):
+        # per subject: histogram of results (U .. A*, then Other), total under- and over-prediction in grades,
+        # and the number, mean and standard deviation of residuals (None where too few)
+        if NP is None:
+            self.calculateSlowly()
+        else:
+            self.calculateVectorised()
+        self.means = [total / count if count else None for total, count in zip(self.totals, self.compared)]
+        self.deviations = [math.sqrt(max(0, (squares - total * total / count) / (count - 1))) if count > 1 else None
+                           for total, squares, count in zip(self.totals, self.squares, self.compared)]
+        return self
+
+    def calculateSlowly(self):
+        numsubjects = len(self.subjects)
+        self.histograms = [[0] * SubjectAnalytics.BINS for n in range(numsubjects)]
+        self.under, self.over, self.compared, self.totals, self.squares = ([0] * numsubjects for i in range(5))
+        for n, grade, predicted in zip(self.subjectcol, self.resultcol, self.predictioncol):
+            self.histograms[n][grade] += 1
+            if predicted != SubjectAnalytics.NOPREDICTION:
+                residual = grade - predicted
+                if residual > 0:
+                    self.under[n] += residual
+                else:
+                    self.over[n] -= residual
+                self.compared[n] += 1
+                self.totals[n] += residual
+                self.squares[n] += residual * residual
+
+    def calculateVectorised(self):
+        numsubjects = len(self.subjects)
+        subjects = NP.array(self.subjectcol, dtype=NP.intp)
+        grades = NP.array(self.resultcol, dtype=NP.intp)
+        predicted = NP.array(self.predictioncol, dtype=NP.intp)
+        self.histograms = NP.bincount(subjects * SubjectAnalytics.BINS + grades,
+                                      minlength=numsubjects * SubjectAnalytics.BINS) \
+                            .reshape(numsubjects, SubjectAnalytics.BINS).tolist()
+        compared = predicted != SubjectAnalytics.NOPREDICTION
+        subjects = subjects[compared]
+        residuals = grades[compared] - predicted[compared]
+        # integer sums weighted by residual (float64 is exact for these)
+        sums = lambda weights: [int(v) for v in NP.bincount(subjects, weights=weights, minlength=numsubjects)]
+        self.under = sums(NP.maximum(residuals, 0))
+        self.over = sums(NP.maximum(-residuals, 0))
+        self.compared = NP.bincount(subjects, minlength=numsubjects).tolist()
+        self.totals = sums(residuals)
+        self.squares = sums(residuals * residuals)
+
+    def getHistogram(self, n):
+        return self.histograms[n]
+
+    def getUnderPrediction(self, n):
+        return self.under[n]
+
+    def getOverPrediction(self, n):
+        return self.over[n]
+
+    def getNumCompared(self, n):
+        return self.compared[n]
+
+    def getMeanResidual(self, n):
+        return self.means[n]
+
+    def getResidualDeviation(self, n):
+        return self.deviations[n]
+
 #########################################################################################################
 #
 #  CLASS SUBJECTMANAGER
@@ -1411,10 +2731,18 @@ class SubjectManager():
     def __init__(self, app):
         self.app = app
         self.subjects = []      # list of subject objects
+        self.version = 0        # bumped whenever subjects or their mappings change - reports are cached against it
 
     def getSubjects(self):
         return self.subjects
 
+    def dataChanged(self):
+        # call after any change to the subjects or their SIMS mappings
+        self.version += 1
+
+    def getVersion(self):
+        return self.version
+
     def getNumSubjects(self):
         return len(self.subjects)
 
@@ -1441,6 +2769,7 @@ class SubjectManager():
                 return False
             self.app.validateLicence(pickle.load(f),'student datafile '+pklfile)
             self.subjects = pickle.load(f)
+        self.dataChanged()
         logwrite('success!')
         return True
 
@@ -1474,6 +2803,7 @@ class SubjectManager():
                     break
             row = f.readline()
         f.close()
+        self.dataChanged()
         logwrite('success - any mappings listed above were completed')
 
     def updateSubjectMapping(self):
@@ -1538,6 +2868,160 @@ class SubjectManager():
     def addSubjectfromBasedata(self, bdsubject):
         self.subjects.append(bdsubject)
 
+#########################################################################################################
+#
+#   CLASS SEARCHINDEX - trigram postings over the fields the browser search looks at
+#
+#########################################################################################################
+
+class SearchIndex():
+    # The search matches a term anywhere in a student's personal details, in one of their choices at the
+    # date being browsed or in one of their results. Each of these is held here as lower case '#'-joined
+    # strings (a 'document' per student for each part - PERSONAL, RESULTS or an ASR date for choices) with
+    # postings from every trigram to the students whose document contains it. A search intersects the
+    # postings for the term's trigrams and then checks just those students' documents. update() brings the
+    # index up to date with the data: only changed personal details and results, and new ASR dates,
+    # are indexed. update() is only called from the Tk thread, once an import has finished; searches run
+    # on the SearchWorker thread, so the lock keeps them from reading the index while it's being updated.
+
+    GRAM        = 3
+    PERSONAL    = '#personal'
+    RESULTS     = '#results'
+
+    def __init__(self):
+        self.documents = {}     # k=part, v=dict k=UCAS ID, v=list of strings
+        self.postings = {}      # k=part, v=dict k=trigram, v=set of UCAS IDs
+        self.version = None     # data versions when last brought up to date
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def update(self, studentmanager, subjectmanager):
+        with self.lock:
+            return self.updateLocked(studentmanager, subjectmanager)
+
+    def updateLocked(self, studentmanager, subjectmanager):
+        version = (studentmanager.getVersion(), subjectmanager.getVersion())
+        if version == self.version:
+            return self
+        for student in studentmanager.getStudents():    # only changed documents are re-indexed
+            ucasid = student.getUcasID()
+            self.setDocument(SearchIndex.PERSONAL, ucasid, [self.getPersonalString(student)])
+            self.setDocument(SearchIndex.RESULTS, ucasid, self.getResultStrings(student, subjectmanager))
+        for thedate in studentmanager.getAllDatesSeen():
+            if thedate not in self.documents:   # choices at an imported date don't change after
+                for student in studentmanager.getStudents():
+                    self.setDocument(thedate, student.getUcasID(), self.getChoiceStrings(student, thedate))
+        self.version = version
+        return self
+
+    def getVersion(self):
+        return self.version
+
+    def getPersonalString(self, student):
+        return '#'.join([ student.getName(),
+                          student.getUPN(),
+                          student.getUcasID(),
+                          student.getCycle(),
+                          student.getDOBstring('%d%m%Y'),
+                          student.getDOBstring('%d/%m/%Y'),
+                          student.getDOBstring('%d-%m-%Y'),
+                          student.getPCode() ]).lower()
+
+    def getChoiceStrings(self, student, thedate):
+        return ['#'.join([ c.getUni(),
+                           c.getCrs(),
+                           c.getCrsText(),
+                           c.getOfferGrades(astar=True),
+                           c.getFullOutcome() ]).lower() for c in student.getChoices(thedate)]
+
+    def getResultStrings(self, student, subjectmanager):
+        strings = []
+        for code, r in student.getResults().items():
+            subject = subjectmanager.getSubjectbyUnitCode(r.getUnitCode())
+            strings.append('#'.join([ code,
+                                      subject.getName() if subject else '',
+                                      subject.getSIMSName() if subject else '' ]).lower())
+        return strings
+
+    def getGrams(self, strings):
+        n = SearchIndex.GRAM
+        return {s[i:i+n] for s in strings for i in range(len(s)-n+1)}
+
+    def setDocument(self, part, ucasid, strings):
+        documents = self.documents.setdefault(part, {})
+        postings = self.postings.setdefault(part, {})
+        old = documents.get(ucasid)
+        if old == strings:
+            return
+        if old:
+            for gram in self.getGrams(old):
+                postings[gram].discard(ucasid)
+        documents[ucasid] = strings
+        for gram in self.getGrams(strings):
+            if gram not in postings:
+                postings[gram] = set()
+            postings[gram].add(ucasid)
+
+    def search(self, target, thedate, cancelled=None):
+        # set of UCAS IDs of students matching the (lower case) target - None if cancelled() turns true
+        matches = set()
+        with self.lock:
+            for part in (SearchIndex.PERSONAL, SearchIndex.RESULTS, thedate):
+                documents = self.documents.get(part)
+                if not documents:
+                    continue
+                if cancelled is not None and cancelled():
+                    return None
+                matches |= self.filter(part, self.getCandidates(part, target), target)
+        return matches
+
+    def searchInOrder(self, ucasids, target, thedate):
+        # generator of those of ucasids that match target, in the order given
+        with self.lock:
+            parts = [(self.documents[part], self.getCandidates(part, target))
+                     for part in (SearchIndex.PERSONAL, SearchIndex.RESULTS, thedate) if self.documents.get(part)]
+            for ucasid in ucasids:
+                for documents, candidates in parts:
+                    if ucasid in candidates and any(target in s for s in documents[ucasid]):
+                        yield ucasid
+                        break
+
+    def getCandidates(self, part, target):
+        # UCAS IDs whose document for this part has every trigram of target - all of them if target is short
+        if len(target) < SearchIndex.GRAM:
+            return self.documents[part].keys()
+        postings = self.postings[part]
+        lists = sorted([postings.get(gram, ()) for gram in self.getGrams([target])], key=len)
+        if not lists[0]:
+            return set()
+        return set(lists[0]).intersection(*lists[1:])
+
+    def filter(self, part, ucasids, target):
+        documents = self.documents[part]
+        return {ucasid for ucasid in ucasids if any(target in s for s in documents[ucasid])}
+
+    def narrow(self, ucasids, target, thedate, cancelled=None):
+        # those of ucasids (matches for a term that target contains) that also match target
+        matches = set()
+        with self.lock:
+            for part in (SearchIndex.PERSONAL, SearchIndex.RESULTS, thedate):
+                documents = self.documents.get(part)
+                if not documents:
+                    continue
+                if cancelled is not None and cancelled():
+                    return None
+                matches |= self.filter(part, [ucasid for ucasid in ucasids
+                                              if ucasid not in matches and ucasid in documents], target)
+        return matches
+
 #########################################################################################################
 #
 #   CLASS GUI Manager
@@ -1561,6 +3045,7 @@ class GUIManager:
         self.studentmanager = studentmanager
         self.subjectmanager = subjectmanager
         self.chosendate = self.studentmanager.getCurrentDate()
+        self.searchworker = None    # SearchWorker thread - started by the first search from the GUI
 
     def getFormattedDate(self):
         return self.formatDate(self.getDate())
@@ -1700,75 +3185,180 @@ class GUIManager:
                 d.append(d1)
         return d
 
-    def search(self, target, sortcolumn):
+    def getSearchWorker(self):
+        if self.searchworker is None:
+            self.searchworker = SearchWorker(self.studentmanager)
+        return self.searchworker
+
+class SearchSnapshot():
+    # What one search reads, taken on the Tk thread when the search is asked for: the search index brought
+    # up to date, the students and the cohort evaluation for the date. Imports change student data on the
+    # Tk thread, so the worker never asks the StudentManager for anything itself.
+
+    def __init__(self, studentmanager, thedate):
+        self.index = studentmanager.getSearchIndex()
+        self.version = self.index.getVersion()
+        self.students = list(studentmanager.getStudents())
+        self.cohort = studentmanager.getEvaluation(thedate) if thedate is not None and self.students else None
+
+    def isStale(self):
+        # the index has been updated by an import since - the GUI refreshes and asks again after imports
+        return self.index.getVersion() != self.version
+
+class SearchWorker():
+    # Runs searches for the search box on a thread so that typing isn't held up. Every request gets the
+    # next generation number and a search gives up as soon as a newer request is made. Pages are left in a
+    # queue for the GUI to collect (with after() polling) - the thread never touches Tk. For the name sort
+    # the first page is found and sent before the full set of matches. Every request ends with one page
+    # with its total, or with rows None if it was dropped. Recent searches are kept here, and
+    # only the worker thread uses them: a term that extends the last one (eg as it is typed) only checks
+    # the last term's matches.
+
+    MAXSEARCHES = 32    # recent searches remembered
+    CHECKEVERY  = 64    # students between checks for a newer request
+
+    def __init__(self, studentmanager):
+        self.studentmanager = studentmanager
+        self.generation = 0
+        self.requests = queue.Queue()
+        self.pages = queue.Queue()
+        self.searches = collections.OrderedDict()  # k=(term, date, data versions), v=SearchResults, oldest first
+        self.lastsearch = None                      # key of the last search made
+        self.thread = threading.Thread(target=self.run, name='search', daemon=True)
+        self.thread.start()
+
+    def request(self, target, thedate, sortcolumn, start, count):
+        # call from the Tk thread - returns the generation number that pages for this request will carry
+        snapshot = SearchSnapshot(self.studentmanager, thedate)
+        self.generation += 1
+        self.requests.put((self.generation, target, thedate, snapshot, sortcolumn, start, count))
+        return self.generation
+
+    def isCurrent(self, generation):
+        return generation == self.generation
+
+    def getPages(self):
+        # (generation, rows, total) for each page ready since last asked - total is None for an early page,
+        # and rows and total are None for a search that was dropped
+        pages = []
+        while True:
+            try:
+                pages.append(self.pages.get_nowait())
+            except queue.Empty:
+                return pages
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            try:
+                self.search(*request)
+            except Exception as e:
+                logwrite('#search failed: ' + str(e))
+                self.pages.put((request[0], [], 0))
+
+    def search(self, generation, target, thedate, snapshot, sortcolumn, start, count):
+        cancelled = lambda:not self.isCurrent(generation) or snapshot.isStale()
+        results = None
+        if not cancelled():
+            key = (target, thedate, snapshot.version)
+            if sortcolumn == 0 and start == 0 and not (key in self.searches and self.searches[key].hasRows()):
+                self.pages.put((generation, self.getFirstRows(snapshot, target, thedate, count), None))
+            results = self.getResults(snapshot, key, cancelled)
+        if results is None or cancelled():
+            self.pages.put((generation, None, None))
+        else:
+            self.pages.put((generation, results.getPage(sortcolumn, start, count), results.getNumRows()))
+
+    def getResults(self, snapshot, key, cancelled):
+        # SearchResults for the term - None if cancelled() turns true
+        target, thedate = key[:2]
+        if key in self.searches:
+            self.searches.move_to_end(key)
+            results = self.searches[key]
+        else:
+            last = self.lastsearch
+            if last is not None and last in self.searches and last[0] in target and last[1:] == key[1:]:
+                matches = snapshot.index.narrow(self.searches[last].getMatches(), target, thedate, cancelled)
+            else:
+                matches = snapshot.index.search(target, thedate, cancelled)
+            if matches is None:
+                return None
+            results = SearchResults(matches)
+            self.searches[key] = results
+            if len(self.searches) > SearchWorker.MAXSEARCHES:
+                self.searches.popitem(last=False)
+        self.lastsearch = key
+        if not results.hasRows():
+            rows = self.getRows(snapshot, results.getMatches(), cancelled)
+            if rows is None:
+                return None
+            results.setRows(rows)
+        return results
+
+    def getFirstRows(self, snapshot, target, thedate, count):
+        # the first count rows in student order (which is name order) - found without finding every match
+        ucasids = (s.getUcasID() for s in snapshot.students)
+        first = set()
+        for ucasid in snapshot.index.searchInOrder(ucasids, target, thedate):
+            first.add(ucasid)
+            if len(first) == count:
+                break
+        return self.getRows(snapshot, first)
+
+    def getRows(self, snapshot, matches, cancelled=None):
+        # the row shown for each matching student, in student order - None if cancelled() turns true:
+        # [student number, name, course, possible, uni, offer grades, predicted, results]
         dataset = []
-        # Find list of student objects with matching personal or choice details
-        matchlist = []
-        thedate = self.getDate()
-        for i, s in enumerate(self.studentmanager):
-            # search in student data
-            data = [ s.getName(),
-                     s.getName(),
-                     s.getUPN(),
-                     s.getUcasID(),
-                     s.getCycle(),
-                     s.getDOBstring('%d%m%Y'),
-                     s.getDOBstring('%d/%m/%Y'),
-                     s.getDOBstring('%d-%m-%Y'),
-                     s.getPCode() ]
-            datastring = '#'.join(map(lambda x:x.lower(), data))
-            if target in datastring:
-                matchlist.append(i)
+        cohort = snapshot.cohort
+        for studentnumber, s in enumerate(snapshot.students):
+            if cancelled is not None and studentnumber % SearchWorker.CHECKEVERY == 0 and cancelled():
+                return None
+            if s.getUcasID() not in matches:
                 continue
-            # search in choices
-            choices = s.getChoices(thedate)
-            if choices:
-                for c in choices:
-                    data = [ c.getUni(),
-                             c.getCrs(),
-                             c.getCrsText(),
-                             c.getOfferGrades(astar=True),
-                             c.getFullOutcome() ]
-                    datastring = '#'.join(map(lambda x:x.lower(), data))
-                    if target in datastring and i not in matchlist:
-                        matchlist.append(i)
-            # search in results
-            results = s.getResults()
-            if results:
-                for code, r in results.items():
-                    subj = self.subjectmanager.getSubjectbyUnitCode(r.getUnitCode())
-                    data = [ code,
-                             subj.getName(),
-                             subj.getSIMSName() ]
-                    datastring = '#'.join(map(lambda x:x.lower(), data))
-                    if target in datastring and i not in matchlist:
-                        matchlist.append(i)
-        # Now collect data to be displayed for those matching students
-        if len(matchlist) != 0:   # otherwise "exit search" (in cleartable) gets overwritten
-            for studentnumber in matchlist:
-                s = self.studentmanager.getStudentbyPosition(studentnumber)
-                studentdata = [studentnumber, s.getName(), '', '', '', '', '', '']
-                if thedate is not None:
-                    # get firm or, if not, choice #1
-                    f = s.getFirm(thedate)
-                    note = ' (CF)'
-                    if not f:
-                        # no firm so use first choice, if student has any choices at all
-                        f = s.getChoices(thedate)
-                        if f: f = f[0]
-                        note = ' (#1)'
-                    if f:
-                        studentdata[2] = f.getCrsText()
-                        studentdata[4] = f.getUni()+note
-                        studentdata[5] = f.getOfferGrades(astar=True)
-                    studentdata[3] = s.getPossibleOffers(thedate)
-                    studentdata[6] = s.getPredictedGradeString()
-                    studentdata[7] = s.getResultsAsOffer().getGrades(astar=True)
-                dataset.append(studentdata)
-            # sort according to selected column
-            dataset.sort(key=lambda x:x[sortcolumn+1])
+            studentdata = [studentnumber, s.getName(), '', '', '', '', '', '']
+            if cohort is not None:
+                # firm or, if not, choice #1
+                f = cohort.mainchoices[studentnumber]
+                if f:
+                    studentdata[2] = f.getCrsText()
+                    studentdata[4] = f.getUni()+cohort.mainnotes[studentnumber]
+                    studentdata[5] = f.getOfferGrades(astar=True)
+                studentdata[3] = cohort.possibleoffers[studentnumber]
+                studentdata[6] = cohort.predictions[studentnumber].getGrades(astar=True)
+                studentdata[7] = cohort.results[studentnumber].getGrades(astar=True)
+            dataset.append(studentdata)
         return dataset
 
+class SearchResults():
+    # One search's matching students (UCAS IDs) and the rows shown for them, made once. The order for each
+    # sort column is worked out the first time it's asked for, so paging and re-sorting just index a list.
+
+    def __init__(self, matches):
+        self.matches = matches
+        self.rows = None
+        self.orders = {}    # k=sort column, v=row numbers in that order
+
+    def getMatches(self):
+        return self.matches
+
+    def hasRows(self):
+        return self.rows is not None
+
+    def setRows(self, rows):
+        self.rows = rows
+
+    def getNumRows(self):
+        return len(self.rows)
+
+    def getOrder(self, sortcolumn):
+        if sortcolumn not in self.orders:
+            # stable, so students stay in name order within equal values
+            self.orders[sortcolumn] = sorted(range(len(self.rows)), key=lambda i:self.rows[i][sortcolumn+1])
+        return self.orders[sortcolumn]
+
+    def getPage(self, sortcolumn, start, count):
+        return [self.rows[i] for i in self.getOrder(sortcolumn)[start:start+count]]
+
 #########################################################################################################
 #
 #
@@ -1787,6 +3377,7 @@ class TaurusApp():
     # file ID stamp
     DATAFILETOKEN            = '#!TAURUSDATA'
     BASEFILETOKEN            = '#!TAURUSBASE'
+    SHEETFILETOKEN           = '#!TAURUSSHEET'
     # licence hash salt
     LICSALT                  = '1234567890'
     # constants
@@ -1801,12 +3392,14 @@ class TaurusApp():
         self.studentmanager = StudentManager(self)
         self.subjectmanager = SubjectManager(self)
         self.config = {}        # config parameters loaded below
+        self.reportcache = {}   # k=(report class, options, output file), v=(data version, file stamp) when written
 
         # Set-up and load data structures
         self.setConfigParameters()
         self.studentmanager.loadStudents()
         self.subjectmanager.loadSubjects()
         self.subjectmanager.mapSubjects()
+        self.studentmanager.getSearchIndex()
 
         # Create GUI instance
         self.guimanager = None     # gui helper object
@@ -2017,9 +3610,9 @@ class TaurusApp():
     #
     #################################################################################
 
-    def trytoopen(self, filename, msg='', mode='r'):
+    def trytoopen(self, filename, msg='', mode='r', buffering=-1):
         try:
-            handle = open(filename,mode)
+            handle = open(filename,mode,buffering)
         except IOError:
             logwrite(msg.replace('%F', filename))
             return TaurusApp.OPENFAIL
@@ -2054,6 +3647,12 @@ class TaurusApp():
             return None
         return filename
 
+    def chooseFilestoOpen(self, options):
+        filenames = [f for f in self.gui.fileOpenMultipleDialog(**options) if os.path.isfile(f)]
+        if len(filenames) == 0:
+            logwrite('#no files chosen OR user cancelled - ignoring')
+        return filenames
+
     def getASRimportfilenames(self):
         # Look in ASR path for files that contain data with dates not in the
         # current pickled dataset (which we loaded on App startup).
@@ -2138,11 +3737,15 @@ class TaurusApp():
                         else:
                             # report unexpected line
                             logwrite('#unexpected line in file was ignored:\n' + ','.join(record))
+                    self.studentmanager.updateTrends(fileDateStr)
                 # end of IF already imported...
             # end WITH ... now add new file date to list of absorbed data dates
         # end FOR available files ... finished looping through available files
+        logwrite('@offer cache ' + str(Offer.getCacheStats()))
         # save and update gui
+        self.studentmanager.dataChanged()
         self.studentmanager.saveStudents()
+        self.studentmanager.getSearchIndex()    # index the new date now rather than on the first search
         self.gui.refreshData()
 
 #######################################################################
@@ -2151,13 +3754,38 @@ class TaurusApp():
 #
 #######################################################################
 
+    def getDataVersion(self):
+        return (self.studentmanager.getVersion(), self.subjectmanager.getVersion())
+
+    def getFileStamp(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def isReportCurrent(self, reportclass, args, outputfilename):
+        # a report is current if it was written from this version of the data and the file hasn't been touched
+        written = self.reportcache.get((reportclass, args, outputfilename))
+        return written is not None and written == (self.getDataVersion(), self.getFileStamp(outputfilename))
+
+    def reportWritten(self, reportclass, args, outputfilename, version):
+        self.reportcache[(reportclass, args, outputfilename)] = (version, self.getFileStamp(outputfilename))
+
+    def runReport(self, reportclass, args, name):
+        # Write the report unless the file already there was written from the same data
+        outputfilename = self.getReportFileName(name)
+        if self.isReportCurrent(reportclass, args, outputfilename):
+            logwrite('data unchanged since the last run - existing file kept')
+        elif reportclass(self, *args).run(outputfilename):
+            self.reportWritten(reportclass, args, outputfilename, self.getDataVersion())
+        return outputfilename
+
     def reportByStudent(self):
         # Create By Student report file: number of choices by decision type.
         if self.studentmanager.isLoaded():
             logwrite('starting report by student')
-            report = ByStudentReport(self)
-            outputfilename = self.getReportFileName('byStudent')
-            report.run(outputfilename)
+            outputfilename = self.runReport(ByStudentReport, (), 'byStudent')
             logwrite('completed report by student to '+outputfilename)
         else:
             logwrite('no UCAS data loaded for report by student')
@@ -2167,9 +3795,7 @@ class TaurusApp():
         if reportall or len(self.studentmanager.getAllDatesSeen()) >= 2:
             typemsg = 'all' if reportall else 'updates'
             logwrite('starting offers report (' + typemsg + ')')
-            report = OffersReport(self, reportall)
-            outputfilename = self.getReportFileName('offers-' + typemsg)
-            report.run(outputfilename)
+            outputfilename = self.runReport(OffersReport, (reportall,), 'offers-' + typemsg)
             logwrite('completed offers report to ' + outputfilename)
         else:
             logwrite('need at least two ASR datasets loaded to report updates')
@@ -2178,9 +3804,7 @@ class TaurusApp():
         # Create By Uni report file - decisions for all students by university.
         if self.studentmanager.isLoaded():
             logwrite('starting report by uni')
-            report = ByUniReport(self)
-            outputfilename = self.getReportFileName('byUni')
-            report.run(outputfilename)
+            outputfilename = self.runReport(ByUniReport, (), 'byUni')
             logwrite('completed report by uni to '+outputfilename)
         else:
             logwrite('no UCAS data loaded for report by uni')
@@ -2189,9 +3813,7 @@ class TaurusApp():
         # Create By subject report file - results by subject.
         if self.studentmanager.isLoaded() and self.subjectmanager.getNumSubjects() > 0:
             logwrite('starting report by subject')
-            report = BySubjectReport(self)
-            outputfilename = self.getReportFileName('bySubject')
-            report.run(outputfilename)
+            outputfilename = self.runReport(BySubjectReport, (), 'bySubject')
             logwrite('completed report by subject to '+outputfilename)
         else:
             logwrite('no UCAS or basedata loaded for report by subject')
@@ -2200,9 +3822,7 @@ class TaurusApp():
         # Create At Risk report file - students whose predictions are below firm offer etc.
         if self.studentmanager.isLoaded():
             logwrite('starting "at risk" report')
-            report = AtRiskReport(self)
-            outputfilename = self.getReportFileName('atRisk')
-            report.run(outputfilename)
+            outputfilename = self.runReport(AtRiskReport, (), 'atRisk')
             logwrite('completed "at risk" report to '+outputfilename)
         else:
             logwrite('no UCAS data loaded for "at risk" report')
@@ -2211,13 +3831,98 @@ class TaurusApp():
         # Create destinations report file - outcome for firm and insc by student
         if self.studentmanager.isLoaded():
             logwrite('starting destinations report')
-            report = DestinationsReport(self)
-            outputfilename = self.getReportFileName('destinations')
-            report.run(outputfilename)
+            outputfilename = self.runReport(DestinationsReport, (), 'destinations')
             logwrite('completed destinations report to '+outputfilename)
         else:
             logwrite('no UCAS data loaded for destinations report')
 
+    def reportTrends(self):
+        # Create trends report - choice outcomes at each imported ASR date, overall and by uni
+        if self.studentmanager.isLoaded():
+            logwrite('starting trends report')
+            outputfilename = self.runReport(TrendReport, (), 'trends')
+            logwrite('completed trends report to '+outputfilename)
+        else:
+            logwrite('no UCAS data loaded for trends report')
+
+    def reportQuery(self, text=None):
+        # Create query report - counts etc over all choices at all dates, eg
+        #   count by uni where outcome=REJ and date>=previous
+        if not self.studentmanager.isLoaded():
+            logwrite('no UCAS data loaded for query')
+            return
+        if text is None:
+            text = self.gui.askString('Query', 'Aggregates (count, sum/mean/min/max(column)), then optionally\n'
+                                      'by column, ... and where column=value, ...\n\ncolumns: ' +
+                                      ', '.join(ChoiceTable.COLUMNS))
+        if not text:
+            return
+        try:
+            # check values (numbers, dates) too, before the output file is opened
+            ChoiceQuery.parse(text).getTests(self.studentmanager.getChoiceTable())
+        except ValueError as e:
+            logwrite('query not understood: ' + str(e))
+            return
+        logwrite('starting query: ' + text)
+        outputfilename = self.runReport(QueryReport, (text,), 'query')
+        logwrite('completed query to '+outputfilename)
+
+    def reportAll(self):
+        # Create every report that the loaded data allows, with a single traversal of the students
+        if not self.studentmanager.isLoaded():
+            logwrite('no UCAS data loaded for reports')
+            return
+        logwrite('starting all reports')
+        jobs = [(OffersReport, (True,), 'offers-all')]
+        if len(self.studentmanager.getAllDatesSeen()) >= 2:
+            jobs.append((OffersReport, (False,), 'offers-updates'))
+        jobs.extend([(ByStudentReport, (), 'byStudent'),
+                     (ByUniReport, (), 'byUni'),
+                     (DestinationsReport, (), 'destinations'),
+                     (AtRiskReport, (), 'atRisk'),
+                     (ClearingReport, (), 'clearing'),
+                     (AdmissionProbabilityReport, (), 'admissionProbability'),
+                     (TrendReport, (), 'trends')])
+        if self.subjectmanager.getNumSubjects() > 0:
+            jobs.append((BySubjectReport, (), 'bySubject'))
+        jobs = [(reportclass, args, self.getReportFileName(name)) for reportclass, args, name in jobs]
+        current = [job for job in jobs if self.isReportCurrent(*job)]
+        for reportclass, args, outputfilename in current:
+            logwrite('data unchanged since the last run - kept report '+outputfilename)
+        jobs = [job for job in jobs if job not in current]
+        if not jobs:
+            return
+        version = self.getDataVersion()
+        if ParallelReportRunner.isWorthwhile(self.studentmanager):   # off until MINSTUDENTS is set
+            runner = ParallelReportRunner(self, jobs)
+        else:
+            runner = ReportPipeline(self.studentmanager,
+                                    [(reportclass(self, *args), outputfile) for reportclass, args, outputfile in jobs])
+        written = runner.run()
+        for reportclass, args, outputfilename in jobs:
+            if outputfilename in written:
+                self.reportWritten(reportclass, args, outputfilename, version)
+                logwrite('completed report '+outputfilename)
+
+    def reportClearing(self):
+        # Create clearing suggestions report - offers made to the cohort at or below the points of students
+        # who missed their firm and insurance offers
+        if self.studentmanager.isLoaded():
+            logwrite('starting clearing suggestions report')
+            outputfilename = self.runReport(ClearingReport, (), 'clearing')
+            logwrite('completed clearing suggestions report to '+outputfilename)
+        else:
+            logwrite('no UCAS data loaded for clearing suggestions report')
+
+    def reportAdmissionProbability(self):
+        # Create admission probability report - simulated chance of meeting firm and insc by student
+        if self.studentmanager.isLoaded():
+            logwrite('starting admission probability report')
+            outputfilename = self.runReport(AdmissionProbabilityReport, (), 'admissionProbability')
+            logwrite('completed admission probability report to '+outputfilename)
+        else:
+            logwrite('no UCAS data loaded for admission probability report')
+
     ##########################################################################
     #
     # Data import and export routines - each uses a data source object
@@ -2261,28 +3966,34 @@ class TaurusApp():
             rowdata.extend(outcomes)
             rowdata.extend(wasinterviewed)
             mydata.append(rowdata)
-        # Read and update the XML marksheet
+        # Read and update the XML marksheets - several can be chosen e.g. one per tutor group
         opts = {'defaultextension': '.xml',
                 'initialdir':self.config['ASRPATH'],
-                'title':'Choose SIMS Marksheet file to import from'}
-        infile = self.chooseFiletoOpen(opts)
-        if not infile:
+                'title':'Choose SIMS Marksheet file(s) to import from'}
+        infiles = self.chooseFilestoOpen(opts)
+        if not infiles:
             logwrite('#cancelled by user')
             return
-        opts['initialdir'] = self.config['OUTPATH']
-        opts['title'] = 'Choose SIMS Marksheet file to export to'
-        outfile = self.gui.fileSaveAsDialog(**opts)
-        lastslash = outfile.rfind('/')
-        if lastslash == -1:
-            logwrite('#no backslash in outfilename OR user cancelled - ignoring')
-            return
-        g = self.trytoopen(outfile, 'cannot open output file - file open?', mode='wb')
-        if g == TaurusApp.OPENFAIL:
-            return
-        logwrite('@begin SAX parse of input file')
-        with g:
-            SAX.parse(infile, SIMSXMLWriter(self, g, mydata))
-        logwrite('success - marksheet updated and ready for import to SIMS')
+        if len(infiles) == 1:
+            opts['initialdir'] = self.config['OUTPATH']
+            opts['title'] = 'Choose SIMS Marksheet file to export to'
+            outfile = self.gui.fileSaveAsDialog(**opts)
+            lastslash = outfile.rfind('/')
+            if lastslash == -1:
+                logwrite('#no backslash in outfilename OR user cancelled - ignoring')
+                return
+            outfiles = [outfile]
+        else:   # several marksheets are written to the output folder under their own names
+            outfiles = [self.getFullPath('OUTPATH') + self.getConfig('OUTNAME') + 'marksheet-' +
+                        os.path.basename(infile) for infile in infiles]
+        for infile, outfile in zip(infiles, outfiles):
+            template = SIMSXMLTemplate.load(self, infile)
+            g = self.trytoopen(outfile, 'cannot open output file %F - file open?', mode='wb')
+            if g == TaurusApp.OPENFAIL:
+                continue
+            with g:
+                SIMSXMLWriter(self, g, mydata).write(template)
+            logwrite('success - marksheet ' + outfile + ' updated and ready for import to SIMS')
 
     def importSIMSpredictions(self):
         # Read exported SIMS marksheet (XML) and extract predictions data
@@ -2300,10 +4011,8 @@ class TaurusApp():
         if not infile:
             return
         logwrite('starting to read imported file')
-        SXReader = SIMSXMLReader()
-        SAX.parse(infile, SXReader)
         headerline = True
-        for row in SXReader:
+        for row in SIMSXMLReader(infile):
             if headerline:
                 if 'upn' in map(lambda x:x.lower(), row):   # marksheet always has Upn in first column
                     headerline = False      # now seen headers, rest is students
@@ -2348,8 +4057,10 @@ class TaurusApp():
                             pass    # same grade was imported again
         logwrite('success - predictions imported')
         logwrite('use Excel to update subject mappings file')
+        self.getStudentManager().dataChanged()
         self.getStudentManager().saveStudents()
         self.getSubjectManager().updateSubjectMapping()
+        self.getStudentManager().getSearchIndex()
         self.gui.refreshData()
 
 
@@ -2362,8 +4073,10 @@ class TaurusApp():
                 subjects.addSubjectfromBasedata(bdsubject)
         logwrite('success - subjects added')
         logwrite('use Excel to update subject mappings file')
+        subjects.dataChanged()
         subjects.saveSubjects()
         subjects.updateSubjectMapping()
+        self.getStudentManager().getSearchIndex()
         self.gui.refreshData()
 
     def importResults(self):
@@ -2397,7 +4110,9 @@ class TaurusApp():
                         logwrite('non A level result ignored: ' + subj.getQualLevel() + ' ' + subj.getName())
         logwrite('success - results imported')
         logwrite('select "Browse" or create destinations report to analyse results')
+        studentmanager.dataChanged()
         studentmanager.saveStudents()
+        studentmanager.getSearchIndex()
         self.gui.refreshData()
 
     def importFromSIMS(self):
@@ -2409,11 +4124,19 @@ class TaurusApp():
             return
         logwrite('starting student details import')
         SIMSreportData = SIMSExtractDS(self)  # pass app object
-        for student in SIMSreportData:
-            if student is not None:
-                logwrite('#student record was updated for ' + student.getName())
-        logwrite('success - student details added')
+        updated = sum([1 for student in SIMSreportData if student is not None])
+        # finally check exam numbers are unique across the whole import
+        for duplicates in SIMSreportData.getDuplicateExamNumbers():
+            logwrite('warning: duplicate exam numbers for: ' + ", ".join([s.getName() for s in duplicates]))
+            logwrite('resolve and re-import')
+        matches = SIMSreportData.getMatches()
+        outputfilename = self.getReportFileName('simsMatch')
+        SIMSMatchReport(self, matches).run(outputfilename)
+        logwrite('success - student details added for ' + str(updated) + ' of ' + str(len(matches)) +
+                 ' SIMS rows: match report written to ' + outputfilename)
+        studentmanager.dataChanged()
         studentmanager.saveStudents()
+        studentmanager.getSearchIndex()
         self.gui.refreshData()
 
 
@@ -2427,26 +4150,48 @@ class TaurusApp():
 
 class StudentReport():  # base class provides common init and save methods
 
+    # Reports are built in three steps so several can share one traversal of the cohort (ReportPipeline):
+    # begin() once, addStudent(n, student) for each student in StudentManager order, then end().
+    # addStudent and end return (or yield) rows as tuples in headings order, which are written straight
+    # to the csv file so rows are never all held in memory.
+
+    WRITEBUFFER = 1 << 16
+
     def __init__(self, app, *args, **kwargs):
         self.app = app
-        self.records = []
         self.studentmanager = app.getStudentManager()
         self.subjectmanager = app.getSubjectManager()
 
     def run(self, outputfile):
-        self.format()           # overridden by subclass depending on report type
-        self.save(outputfile)
+        writer = self.openWriter(outputfile)
+        if writer is None:
+            return False
+        with writer:
+            writer.writeRows(self.rows())
+        return True
 
-    def save(self, filename):  # must not be called on the base class as no 'headings' member
-        f = self.app.trytoopen(filename, 'report file %F may be open or protected: data not written', mode='w')
-        if f != TaurusApp.OPENFAIL:
-            with f:
-                f.write(",".join(self.headings)+'\n')
-                for record in self.records:
-                    line = ''
-                    for heading in self.headings:
-                        line += str(record[heading])+','
-                    f.write(line[:-1]+'\n')  # remove last comma
+    def rows(self):
+        # generator of all the rows of the report
+        self.begin()
+        for n, student in enumerate(self.studentmanager.getStudents()):
+            yield from self.addStudent(n, student)
+        yield from self.end()
+
+    def begin(self):
+        pass
+
+    def addStudent(self, n, student):  # overridden by subclass depending on report type
+        return ()
+
+    def end(self):
+        return ()
+
+    def openWriter(self, filename):  # must not be called on the base class as no 'headings' member
+        f = self.app.trytoopen(filename, 'report file %F may be open or protected: data not written', mode='w',
+                               buffering=StudentReport.WRITEBUFFER)
+        if f == TaurusApp.OPENFAIL:
+            return None
+        return ReportWriter(self, f)
 
     def getItems(self, choice): # used by both Destinations and AtRisk reports
         if choice is None:
@@ -2495,6 +4240,164 @@ class StudentReport():  # base class provides common init and save methods
             return None
         return result
 
+class ReportWriter():
+    # csv output for a report - the heading row is written just before the first row (or on closing)
+    # so that reports can still set their headings in begin() or end()
+
+    def __init__(self, report, f):
+        self.report = report
+        self.file = f
+        self.writer = csv.writer(f, lineterminator='\n')
+        self.started = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, *exc):
+        if exctype is None:
+            self.close()
+        else:
+            self.abandon()
+
+    def writeRows(self, rows):
+        for row in rows:
+            if not self.started:
+                self.writer.writerow(self.report.headings)
+                self.started = True
+            self.writer.writerow(row)
+
+    def close(self):
+        if not self.started:
+            self.writer.writerow(self.report.headings)
+            self.started = True
+        self.file.close()
+
+    def abandon(self):
+        # close without finishing, eg when the report failed - safe to call after close()
+        self.file.close()
+
+class ReportPipeline():
+    # Runs several reports with one traversal of the cohort: every report is begun, each student is passed
+    # to all of them in turn, then every report is ended and saved. Shared data such as the cohort
+    # evaluation is built once by whichever report asks for it first. A report that fails is dropped and
+    # logged, and the others carry on.
+
+    def __init__(self, studentmanager, reports):
+        self.studentmanager = studentmanager
+        self.reports = reports      # list of (report, output filename)
+
+    def run(self):
+        running = []    # (report, writer, output filename) for each report still going
+        written = []
+        try:
+            for report, outputfile in self.reports:
+                writer = report.openWriter(outputfile)
+                if writer is not None:
+                    running.append((report, writer, outputfile))
+                    self.attempt(running, running[-1], report.begin)
+            for n, student in enumerate(self.studentmanager.getStudents()):
+                for job in list(running):
+                    report, writer, outputfile = job
+                    self.attempt(running, job, lambda: writer.writeRows(report.addStudent(n, student)))
+            for job in list(running):
+                report, writer, outputfile = job
+                if self.attempt(running, job, lambda: writer.writeRows(report.end())):
+                    writer.close()
+                    written.append(outputfile)
+        finally:
+            for report, writer, outputfile in running:
+                writer.abandon()
+        return written      # the files written
+
+    def attempt(self, running, job, step):
+        # one step of a report - True if it worked, otherwise the report is taken out of running
+        try:
+            step()
+            return True
+        except Exception as e:
+            report, writer, outputfile = job
+            running.remove(job)
+            writer.abandon()
+            logwrite('report failed and is incomplete: ' + outputfile + ' (' + type(e).__name__ + ': ' + str(e) + ')')
+            return False
+
+class ReportSnapshot():
+    # Read-only copy of the loaded student and subject data, pickled once in the app's process and sent
+    # to each worker process. Once restored it stands in for the app as far as the reports are concerned.
+
+    def __init__(self, app):
+        studentmanager = app.getStudentManager()
+        self.data = pickle.dumps((studentmanager.students, studentmanager.withDates, studentmanager.getTrends(),
+                                  app.getSubjectManager().subjects), pickle.HIGHEST_PROTOCOL)
+        self.studentmanager = None
+        self.subjectmanager = None
+
+    def __getstate__(self):
+        # just the pickled data crosses to the worker
+        return {'data': self.data, 'studentmanager': None, 'subjectmanager': None}
+
+    def restore(self):
+        self.studentmanager = StudentManager(self)
+        self.subjectmanager = SubjectManager(self)
+        (self.studentmanager.students, self.studentmanager.withDates, self.studentmanager.trends,
+         self.subjectmanager.subjects) = pickle.loads(self.data)
+        return self
+
+    def getStudentManager(self):
+        return self.studentmanager
+
+    def getSubjectManager(self):
+        return self.subjectmanager
+
+    trytoopen = TaurusApp.trytoopen
+
+class ParallelReportRunner():
+    # Builds reports in worker processes, each working from its own ReportSnapshot. The jobs given to one
+    # worker run as a ReportPipeline, so every file is written exactly as it would be by the serial path.
+    # Worker log messages are passed back and written here in job order. Workers are spawned, not forked,
+    # so they don't inherit the Tk process and its threads.
+
+    MINSTUDENTS = None      # reportAll stays serial until taurusBench shows a speedup on multi-core hardware
+
+    def __init__(self, app, jobs, processes=None):
+        self.app = app
+        self.jobs = jobs        # list of (report class, args tuple, output filename)
+        self.processes = max(1, min(processes or os.cpu_count() or 1, len(jobs)))
+
+    @staticmethod
+    def isWorthwhile(studentmanager):
+        minstudents = ParallelReportRunner.MINSTUDENTS
+        return minstudents is not None and (os.cpu_count() or 1) > 1 and \
+               len(studentmanager.getStudents()) >= minstudents
+
+    @staticmethod
+    def buildReports(snapshot, jobs):
+        # runs in the worker process, which has no app and so no logger of its own
+        global logwrite
+        messages = []
+        applogwrite = globals().get('logwrite')    # none yet in a spawned worker
+        logwrite = messages.append
+        try:
+            app = snapshot.restore()
+            written = ReportPipeline(app.getStudentManager(),
+                                     [(reportclass(app, *args), outputfile)
+                                      for reportclass, args, outputfile in jobs]).run()
+        finally:
+            logwrite = applogwrite
+        return messages, written
+
+    def run(self):
+        groups = [self.jobs[i::self.processes] for i in range(self.processes)]
+        snapshot = ReportSnapshot(self.app)
+        written = set()
+        with concurrent.futures.ProcessPoolExecutor(self.processes,
+                                                    mp_context=multiprocessing.get_context('spawn')) as pool:
+            for messages, files in pool.map(ParallelReportRunner.buildReports, [snapshot]*len(groups), groups):
+                for message in messages:
+                    logwrite(message)
+                written.update(files)
+        return [outputfile for reportclass, args, outputfile in self.jobs if outputfile in written]
+
 class OffersReport(StudentReport):
 
     def __init__(self, *args, **kwargs):
@@ -2505,88 +4408,51 @@ class OffersReport(StudentReport):
         if not self.reportall:
             self.headings.append('Status')
 
-    def format(self):
-        for student in self.studentmanager:
-            record = {}
-            if student.isNew(): # show new applicants whether or not reporting all offers
-                for heading in self.headings:
-                    record[heading] = ''
-                record[self.headings[0]] = student.getName()
-                index = 4 if self.reportall else 5
-                record[self.headings[index]] = 'NEW APPLICANT'
-                self.records.append(record)
-            else:
-                choices = student.getChoices(self.studentmanager.getCurrentDate())
-                if choices:
-                    for choice in choices: # report all offers or just updated choices
-                        if (not self.reportall and choice.hasUpdated()) or (self.reportall and choice.isOffer()):
-                            record = {	self.headings[0]: student.getName(),
-                                        self.headings[1]: choice.getCrsText(),
-                                        self.headings[2]: choice.getUni(),
-                                        self.headings[3]: self.prettifyOutcome(choice.getOutcome()),
-                                        self.headings[4]: choice.getOfferGrades(astar=True)  }
-                            if not self.reportall:
-                                record[self.headings[5]] = self.prettifyStatus(choice.getUpdated())
-                            self.records.append(record)
+    def begin(self):
+        self.currentDate = self.studentmanager.getCurrentDate()
+
+    def addStudent(self, n, student):
+        if student.isNew(): # show new applicants whether or not reporting all offers
+            row = [''] * len(self.headings)
+            row[0] = student.getName()
+            row[4 if self.reportall else 5] = 'NEW APPLICANT'
+            yield row
+        else:
+            for choice in student.getChoices(self.currentDate): # report all offers or just updated choices
+                if (not self.reportall and choice.hasUpdated()) or (self.reportall and choice.isOffer()):
+                    row = ( student.getName(),
+                            choice.getCrsText(),
+                            choice.getUni(),
+                            self.prettifyOutcome(choice.getOutcome()),
+                            choice.getOfferGrades(astar=True) )
+                    if not self.reportall:
+                        row += (self.prettifyStatus(choice.getUpdated()),)
+                    yield row
 
 class BySubjectReport(StudentReport):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.headings = ['Subject Name', 'SIMS Code', 'Unit', 'A*', 'A', 'B', 'C',
-                         'D', 'E', 'U', 'Other', 'UnderPrediction', 'OverPrediction']
-
-    def format(self):
-        ConvertGrade = lambda x:'U E D C B A A*'.index(x)//2
-        records = {}    # empty dict
-        for subject in self.subjectmanager.getSubjects():
-            if subject.getSIMSName():
-                n = subject.getName()
-                if ',' in n:
-                    n = '"'+n+'"'
-                record = { self.headings[0]: n,
-                           self.headings[1]: subject.getSIMSName(),
-                           self.headings[2]: subject.getUnitCode(),
-                           self.headings[3]: 0,
-                           self.headings[4]: 0,
-                           self.headings[5]: 0,
-                           self.headings[6]: 0,
-                           self.headings[7]: 0,
-                           self.headings[8]: 0,
-                           self.headings[9]: 0,
-                           self.headings[10]: 0,
-                           self.headings[11]: 0,
-                           self.headings[12]: 0,
-                           }
-                records[subject.getUnitCode()] = record
-        for student in self.studentmanager:
-            studentresults = student.getResults()
-            studentpredictions = student.getPredictions()
-            for code, result in studentresults.items():
-                try:
-                    gindex = ConvertGrade(result.getGrade())
-                except ValueError:
-                    gindex = 10         # other
-                if code in records:     # only count results for which there are predictions
-                    records[code][self.headings[9-gindex]] += 1
-                    simscode = self.subjectmanager.getSubjectbyUnitCode(code).getSIMSName()
-                    try:
-                        predictedgrade = studentpredictions[simscode]
-                    except KeyError:    # no prediction for this (retake?)
-                        predictedgrade = studentresults[code].getGrade() # just count it as 0
-                    try:
-                        diff = ConvertGrade(studentresults[code].getGrade()) - ConvertGrade(predictedgrade)
-                    except ValueError:
-                        logwrite('grade '+studentresults[code].getGrade()+' or '+predictedgrade+' not a grade!')
-                    if diff > 0:
-                        records[code][self.headings[11]] += diff
-                    else:
-                        records[code][self.headings[12]] += -diff
-                else:
-                    logwrite('code '+str(code)+' not in '+str(studentresults)+' for '+student.getName())
-        self.records = []
-        for r in records:
-            self.records.append(records[r])
+                         'D', 'E', 'U', 'Other', 'UnderPrediction', 'OverPrediction',
+                         'Compared', 'MeanResidual', 'ResidualSD']
+
+    def begin(self):
+        self.analytics = SubjectAnalytics(self.subjectmanager)
+
+    def addStudent(self, n, student):
+        self.analytics.addStudent(student)
+        return ()
+
+    def end(self):
+        analytics = self.analytics.calculate()
+        pretty = lambda x:'' if x is None else '{:.2f}'.format(x)
+        for n, subject in enumerate(analytics.getSubjects()):
+            histogram = analytics.getHistogram(n)
+            yield tuple([subject.getName(), subject.getSIMSName(), subject.getUnitCode()] +
+                        histogram[SubjectAnalytics.OTHER-1::-1] + [histogram[SubjectAnalytics.OTHER]] +
+                        [analytics.getUnderPrediction(n), analytics.getOverPrediction(n), analytics.getNumCompared(n),
+                         pretty(analytics.getMeanResidual(n)), pretty(analytics.getResidualDeviation(n))])
 
 class ByStudentReport(StudentReport):
 
@@ -2594,113 +4460,114 @@ class ByStudentReport(StudentReport):
         super().__init__(*args, **kwargs)
         self.headings = ['Name','U','C','INV','REF','REJ','W','Other','Choice Status']
 
-    def format(self):
-        currentDate = self.studentmanager.getCurrentDate()
-        for student in self.studentmanager:
-            record = {	self.headings[0]: student.getName(),
-                          self.headings[1]: student.getUnconditionals(currentDate),
-                          self.headings[2]: student.getConditionals(currentDate),
-                          self.headings[3]: student.getInterviews(currentDate),
-                          self.headings[4]: student.getReferrals(currentDate),
-                          self.headings[5]: student.getRejections(currentDate),
-                          self.headings[6]: student.getWithdrawals(currentDate)  }
-            totalsofar = sum((record[self.headings[i]] for i in range(1,7)))
-            record[self.headings[7]] = student.getTotalChoices(currentDate) - totalsofar
-            status = ''
-            if student.getFirm(currentDate) is not None:
-                status = 'CHOICES MADE (F=' + student.getFirm(currentDate).getOfferGrades(astar=True)
-                if student.getInsc(currentDate) is None:
-                    if student.getFirm(currentDate).getOutcome() != Outcome.U:
-                        logwrite('warning: CF with no insurance for ' + student.getName())
-                else:
-                    status += ' I=' + student.getInsc(currentDate).getOfferGrades(astar=True)
-                    if student.acceptanceAnomaly(currentDate):
-                        logwrite('insurance offer higher than firm for ' + student.getName()
-                                  + ': firm grades = ' + student.getFirm(currentDate).getOffer().getFullGrades()
-                                  + ', insc grades = ' + student.getInsc(currentDate).getOffer().getFullGrades()  )
-                status += ')'
+    def begin(self):
+        self.cohort = self.studentmanager.getEvaluation()
+
+    def addStudent(self, n, student):
+        cohort = self.cohort
+        currentDate = cohort.getDate()
+        counts = (  student.getUnconditionals(currentDate),
+                    student.getConditionals(currentDate),
+                    student.getInterviews(currentDate),
+                    student.getReferrals(currentDate),
+                    student.getRejections(currentDate),
+                    student.getWithdrawals(currentDate)  )
+        other = student.getTotalChoices(currentDate) - sum(counts)
+        status = ''
+        firm = cohort.firms[n]
+        insc = cohort.inscs[n]
+        if firm is not None:
+            status = 'CHOICES MADE (F=' + firm.getOfferGrades(astar=True)
+            if insc is None:
+                if firm.getOutcome() != Outcome.U:
+                    logwrite('warning: CF with no insurance for ' + student.getName())
             else:
-                if student.getDecisions(currentDate) == student.getTotalChoices(currentDate):
-                    if student.getTotalOffers(currentDate) == 0:
-                        status = 'IN CLEARING'
-                    elif student.getOpenOffers(currentDate) == 0:
-                        status = 'DECLINED ALL'
-                    else:
-                        status = 'READY TO CHOOSE'
-            record[self.headings[8]] = status
-            self.records.append(record)
+                status += ' I=' + insc.getOfferGrades(astar=True)
+                if cohort.firmpoints[n] <= cohort.inscpoints[n]:    # acceptance anomaly
+                    logwrite('insurance offer higher than firm for ' + student.getName()
+                              + ': firm grades = ' + firm.getOffer().getFullGrades()
+                              + ', insc grades = ' + insc.getOffer().getFullGrades()  )
+            status += ')'
+        else:
+            if student.getDecisions(currentDate) == student.getTotalChoices(currentDate):
+                if student.getTotalOffers(currentDate) == 0:
+                    status = 'IN CLEARING'
+                elif student.getOpenOffers(currentDate) == 0:
+                    status = 'DECLINED ALL'
+                else:
+                    status = 'READY TO CHOOSE'
+        return ((student.getName(),) + counts + (other, status),)
 
 class ByUniReport(StudentReport):
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def begin(self):
+        # outcomes and offers are counted by uni as the students are added
+        self.currentDate = self.studentmanager.getCurrentDate()
+        self.outcomes = {}      # k=uni, v=Counter of outcomes
+        self.offers = {}        # k=uni, v=list of conditional offer grades
+
+    def addStudent(self, n, student):
+        for c in student.getChoices(self.currentDate):
+            uni = c.getUni()
+            if uni not in self.outcomes:
+                self.outcomes[uni] = collections.Counter()
+                self.offers[uni] = []
+            self.outcomes[uni][c.getOutcome()] += 1
+            if c.getOutcome() == Outcome.C:
+                self.offers[uni].append(c.getOfferGrades())
+        return ()
+
+    def end(self):
         # Get a list of universities for headings
-        # ... the {} makes it a set which removes duplicates
-        current = self.studentmanager.getCurrentDate()
-        self.universities = [UniRecord(u) for u in sorted({c.getUni() for s in self.studentmanager
-                                                           for c in s.getChoices(current)})]
+        self.universities = [UniRecord(u) for u in sorted(self.outcomes)]
         for u in self.universities:
-            u.setUnconditionals(self.countOutcomes(u, current, Outcome.U))
-            u.setConditionals(self.countOutcomes(u, current, Outcome.C))
-            u.setRejections(self.countOutcomes(u, current, Outcome.REJ))
-
-        for s in self.studentmanager:
-            for c in s.getChoices(current):
-                if c.getOutcome() == Outcome.C:
-                    u = self.universities[self.universities.index(c.getUni())]
-                    u.addOffer(c.getOfferGrades())
+            counts = self.outcomes[u.getName()]
+            u.setUnconditionals(counts[Outcome.U])
+            u.setConditionals(counts[Outcome.C])
+            u.setRejections(counts[Outcome.REJ])
+            for grades in self.offers[u.getName()]:
+                u.addOffer(grades)
 
         self.headings = list(map(lambda x: x.getName(), self.universities))
         self.headings.insert(0, 'Total')
         self.headings.insert(0, ' ')
-
-    def format(self):
-        self.prepareTotalsByUni()
-        self.prepareBreakdownByOfferConditions()
-        
-    def countOutcomes(self, u, thisdate, thisoutcome):
-        return sum([1 for s in self.studentmanager for c in s.getChoices(thisdate)
-                         if c.getUni() == u.getName() and c.getOutcome() == thisoutcome])
+        yield from self.prepareTotalsByUni()
+        yield from self.prepareBreakdownByOfferConditions()
 
     def prepareTotalsByUni(self):
         funcs = [lambda x:x.getUnconditionals(),lambda x:x.getConditionals(),lambda x:x.getRejections(),lambda x:0 if x.getTotalOutcomes()==0 else (x.getConditionals()+x.getUnconditionals())/x.getTotalOutcomes()]
         for i in range(4):
-            record = {}  # empty record for this report row
-            # set first field to row heading
-            record[self.headings[0]] = "UCR%"[i]
+            # first field is the row heading
+            row = ["UCR%"[i]]
             # get value for total column (heading 1)
             func = funcs[i]
             if i==3:  # percentage calculation
                 v = (sum(map(funcs[0],self.universities))
                      + sum(map(funcs[1],self.universities))) \
                     / sum(map(lambda x:x.getTotalOutcomes(),self.universities))
-                record[self.headings[1]] = str(int(v*100))
+                row.append(str(int(v*100)))
             else:  # just counting
                 v = sum(map(func,self.universities))
-                record[self.headings[1]] = str(v)
+                row.append(str(v))
             # get value for each uni column
             for u in self.universities:
-                record[u.getName()] = str(int(func(u)*(1 if i!=3 else 100)))
-            self.records.append(record)
+                row.append(str(int(func(u)*(1 if i!=3 else 100))))
+            yield row
 
     def prepareBreakdownByOfferConditions(self):
         # set of all offer conditions
         offers = {(oc.getGrades(astar=True),oc.getGradeValue()) for u in self.universities
                                                         for oc in u.getAllOffers()}
         # breakdown of offers by uni
-        for grades, value in sorted(list(offers), key=lambda x:x[1], reverse=True):
-            record = {}
+        for grades, value in sorted(offers, key=lambda x:(-x[1], x[0])):
             # add row heading
-            if grades == '':
-                record[self.headings[0]] = 'Other'
-            else:
-                record[self.headings[0]] = grades
+            row = ['Other' if grades == '' else grades]
+            row.append('')  # blank underneath Total column
             # add field for each uni
-            record[self.headings[1]] = ''  # blank underneath Total column
             for u in self.universities:
                 count = u.getNumOffers(grades)
-                record[u.getName()] = '' if count == 0 else str(count)
-            self.records.append(record)
+                row.append('' if count == 0 else str(count))
+            yield row
 
 class DestinationsReport(StudentReport):
 
@@ -2711,54 +4578,27 @@ class DestinationsReport(StudentReport):
                          'InscCourse','InscUni','InscGrades','MetInsc?',
                          'ExamNo','ResultGrades','PredGrades','MetPred?', 'UPN']
 
-    def format(self):
-        currentDate = self.studentmanager.getCurrentDate()
-        for student in self.studentmanager:
-            record = {  self.headings[0]: student.getName(),
-                          self.headings[1]: '',
-                          self.headings[2]: student.isCurrentY13(),
-                          self.headings[3]: student.getUcasID(),
-                          self.headings[4]: student.getCycle()  }
-
-            firm = student.getFirm(currentDate)
-            insc = student.getInsc(currentDate)
-            if insc is None:  # can't set I on UCAS without F
-                if firm is None:
-                    logwrite('#no firm (or insc) for ' + student.getName())
-                elif firm.getOutcome() != Outcome.U:
-                    logwrite('#CF but no insc for ' + student.getName())
-            firmitems = self.getItems(firm)
-            inscitems = self.getItems(insc)
-            for i in range(3):
-                record[self.headings[5+i]] = firmitems[i]
-                record[self.headings[9+i]] = inscitems[i]
-            record[self.headings[13]] = student.getExamNo()
-            resoff = student.getResultsAsOffer()
-            record[self.headings[14]] = resoff.getGrades(astar=True)
-            predoff = student.getPredictionsAsOffer()
-            record[self.headings[15]] = predoff.getGrades(astar=True)
-            record[self.headings[16]] = Offer.DESCRIPTIONS[resoff.gradeCompare(predoff, False)]
-            record[self.headings[17]] = student.getUPN()
-            if firm:
-                record[self.headings[8]] = Offer.DESCRIPTIONS[resoff.gradeCompare(firm.getOffer())]
-            else:
-                record[self.headings[8]] = Offer.DESCRIPTIONS[Offer.NOOFFER]
-            if insc:
-                record[self.headings[12]] = Offer.DESCRIPTIONS[resoff.gradeCompare(insc.getOffer())]
-            else:
-                record[self.headings[12]] = Offer.DESCRIPTIONS[Offer.NOOFFER]
+    def begin(self):
+        self.cohort = self.studentmanager.getEvaluation()
+
+    def addStudent(self, n, student):
+        cohort = self.cohort
+        firm = cohort.firms[n]
+        insc = cohort.inscs[n]
+        if insc is None:  # can't set I on UCAS without F
             if firm is None:
-                record[self.headings[1]] = 'No offers'
-            elif resoff.gradeCompare(firm.getOffer()) in Offer.MET:
-                record[self.headings[1]] = 'Firm'
-            elif insc and resoff.gradeCompare(insc.getOffer()) in Offer.MET:
-                record[self.headings[1]] = 'Insc'
-            elif resoff.gradeCompare(firm.getOffer()) in Offer.UNMET \
-                    and insc and resoff.gradeCompare(insc.getOffer()) in Offer.UNMET:
-                record[self.headings[1]] = 'Unmet'
-            else:
-                record[self.headings[1]] = 'CHECK'
-            self.records.append(record)
+                logwrite('#no firm (or insc) for ' + student.getName())
+            elif firm.getOutcome() != Outcome.U:
+                logwrite('#CF but no insc for ' + student.getName())
+        return ((student.getName(), cohort.destinations[n], str(student.isCurrentY13()), student.getUcasID(),
+                 student.getCycle()) +
+                tuple(self.getItems(firm)) + (Offer.DESCRIPTIONS[cohort.firmcompare[n]],) +
+                tuple(self.getItems(insc)) + (Offer.DESCRIPTIONS[cohort.insccompare[n]],) +
+                (student.getExamNo(),
+                 cohort.results[n].getGrades(astar=True),
+                 cohort.predictions[n].getGrades(astar=True),
+                 Offer.DESCRIPTIONS[cohort.predcompare[n]],
+                 student.getUPN()),)
 
 class AtRiskReport(StudentReport):
 
@@ -2767,81 +4607,125 @@ class AtRiskReport(StudentReport):
         self.headings = ['Name','FirmCourse','FirmUni','FirmGrades',
                          'InscCourse','InscUni','InscGrades','Predictions','Risk']
 
-    def format(self):
-        currentDate = self.studentmanager.getCurrentDate()
-        first = True
-        usingresults = False
-        for student in self.studentmanager:
-            record = {  self.headings[0]: student.getName() }
-            firm = student.getFirm(currentDate)
-            insc = student.getInsc(currentDate)
-            firmitems = self.getItems(firm)
-            inscitems = self.getItems(insc)
-            fv = 0
-            iv = 0
-            if firm:
-                fv = firm.getOffer().getGradeValue()
-                if firm.getOutcome() == Outcome.U:
-                    fv = 0
-            if insc:
-                iv = insc.getOffer().getGradeValue()
-            n = 3 # number of predicted grades to consider as counting
-            if firm: n = max(firm.getOffer().numGrades(), n)
-            if insc: n = max(insc.getOffer().numGrades(), n)
-            # report works off actual results if available, otherwise predictions
-            try:
-                pg = student.getResultsAsOffer().getGradeEquivalent(astar=True)
-                pv = student.getResultsAsOffer().getGradeValue()
-                if first:
-                    logwrite('using actual results to determine risk status')
-                    self.headings[self.headings.index('Predictions')] = 'Results'
-                    usingresults = True
-                    first = False
-            except:
-                pg = student.getPredictedGradeString(n)
-                pv = Offer(pg).getGradeValue()
-                if first:
-                    logwrite('using predictions to determine risk status')
-                    first = False
-            # this report contains:
-            # students with no firm
-            # students with a firm offer > predictions
-            # students with a firm = predictions and insc >= predictions
-            # students with a firm = predictions and no insc
-            # determine how at risk this student is
-            risk = ''
-            if firm is None: risk = 'HIGH'
-            if fv > pv:
-                risk = 'HIGH'
-                if fv == 1000: risk += ' (special conditions)'
-                if insc:
-                    if iv == pv:
-                        if not usingresults:
-                            risk = 'MEDIUM'
-                        elif insc.getOffer().getGrades() != pg:
-                            risk = 'LOW'
-                        elif usingresults: # the HIGH can become none as she's got her insc
-                            risk = ''
-                    elif iv < pv:
-                        if not usingresults:
-                            risk = 'LOW'
-                        else:
-                            risk = ''   # got insc
-            if fv > 0 and fv == pv and not usingresults:
-                if iv >= pv or insc is None:
-                    risk = 'MEDIUM'
-                    if iv == 1000: risk = 'MEDIUM (special conditions)'
-                elif iv == pv - 1:
-                    risk = 'LOW'
-                # else FV=PV and IV at least 2 below PV so no risk
-            # only copy at risk students to the report
-            if risk:
-                for i in range(3):
-                    record[self.headings[1+i]] = firmitems[i]
-                    record[self.headings[4+i]] = inscitems[i]
-                record[self.headings[7]] = pg
-                record[self.headings[8]] = risk
-                self.records.append(record)
+    def begin(self):
+        self.cohort = self.studentmanager.getEvaluation()
+        # report works off actual results if available, otherwise predictions
+        if self.cohort.isUsingResults():
+            logwrite('using actual results to determine risk status')
+            self.headings[self.headings.index('Predictions')] = 'Results'
+        else:
+            logwrite('using predictions to determine risk status')
+
+    def addStudent(self, n, student):
+        cohort = self.cohort
+        # only copy at risk students to the report
+        if not cohort.risks[n]:
+            return ()
+        return ((student.getName(),) + tuple(self.getItems(cohort.firms[n])) + tuple(self.getItems(cohort.inscs[n])) +
+                (cohort.riskgrades[n], cohort.risks[n]),)
+
+class AdmissionProbabilityReport(StudentReport):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.headings = ['Name','FirmUni','FirmGrades','InscUni','InscGrades','Predictions',
+                         'P(Firm)','P(Insc)','P(Neither)','Risk']
+
+    def begin(self):
+        self.cohort = self.studentmanager.getEvaluation()
+        simulator = AdmissionSimulator().calibrate(self.studentmanager, self.subjectmanager)
+        self.pfirm, self.pinsc = simulator.simulate(self.cohort)
+
+    def addStudent(self, n, student):
+        cohort = self.cohort
+        pfirm = self.pfirm
+        pinsc = self.pinsc
+        firmitems = self.getItems(cohort.firms[n])
+        inscitems = self.getItems(cohort.inscs[n])
+        return ((student.getName(), firmitems[1], firmitems[2], inscitems[1], inscitems[2],
+                 cohort.predictions[n].getGrades(astar=True),
+                 '{:.3f}'.format(pfirm[n]),
+                 '{:.3f}'.format(pinsc[n]),
+                 '{:.3f}'.format(max(0.0, 1 - pfirm[n] - pinsc[n])),  # not -0.000 from rounding
+                 cohort.risks[n]),)
+
+class ClearingReport(StudentReport):
+
+    MAXSUGGESTIONS = 10
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.headings = ['Name','Results','Points','SuggestedUni','SuggestedCourse','OfferGrades',
+                         'OfferPoints','TimesOffered']
+
+    def begin(self):
+        # for students who missed both offers (or had none), the closest offers made at or below the points
+        # for their best three grades that their results meet, each uni and course once
+        self.cohort = self.studentmanager.getEvaluation()
+        self.offerindex = self.studentmanager.getOfferIndex()
+
+    def addStudent(self, n, student):
+        cohort = self.cohort
+        offerindex = self.offerindex
+        if cohort.destinations[n] != CohortEvaluation.UNMET and \
+                not (cohort.destinations[n] == CohortEvaluation.NOOFFERS and student.getResults()):
+            return ()
+        result = cohort.results[n]
+        points = result.getBestGradeValue()
+        seen = {(choice.getUni(), choice.getCrsText()) for choice in student.getChoices(cohort.getDate())}
+        suggestions = []
+        for entry in offerindex.getOffersDownFrom(points):
+            (value, uni, course, grades), count = entry
+            if (uni, course) not in seen and result.compareGrades(Offer.fromString(grades), False) in Offer.MET:
+                seen.add((uni, course))     # highest offer only, where several were made
+                suggestions.append(entry)
+                if len(suggestions) == ClearingReport.MAXSUGGESTIONS:
+                    break
+        return [(student.getName(), cohort.results[n].getGrades(astar=True), points, uni, course, grades, value, count)
+                for (value, uni, course, grades), count in suggestions]
+
+class TrendReport(StudentReport):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.headings = ['ASR Date', 'Uni'] + TrendAggregates.MEASURES
+
+    def rows(self):
+        # made from the stored counts for each date - no need to go through the students
+        trends = self.studentmanager.getTrends()
+        for thedate in trends.getDates():
+            prettydate = thedate[0:2] + '/' + thedate[2:4] + '/' + thedate[4:]
+            for uni in [TrendAggregates.OVERALL] + trends.getUnis(thedate):
+                yield tuple([prettydate, uni or 'All'] +
+                            [trends.getCount(thedate, uni, measure) for measure in TrendAggregates.MEASURES])
+
+    def end(self):
+        # in a pipeline the rows come once the students have been seen
+        return self.rows()
+
+class QueryReport(StudentReport):
+
+    def __init__(self, *args, **kwargs):
+        self.query = ChoiceQuery.parse(args[1])     # arg 0 is the app object
+        super().__init__(*args, **kwargs)
+        self.headings = self.query.getHeadings()
+
+    def rows(self):
+        return self.query.run(self.studentmanager.getChoiceTable())
+
+    def end(self):
+        return self.rows()
+
+class SIMSMatchReport(StudentReport):
+
+    def __init__(self, *args, **kwargs):
+        self.matches = args[1]      # arg 0 is the app object
+        super().__init__(*args, **kwargs)
+        self.headings = ['Line', 'SIMS Name', 'UCAS Name', 'UCAS ID', 'Method', 'Confidence', 'Note']
+
+    def rows(self):
+        for match in self.matches:
+            yield tuple([match[heading] for heading in self.headings])
 
 #########################################################################################################
 #
@@ -2849,30 +4733,216 @@ class AtRiskReport(StudentReport):
 #
 #########################################################################################################
 
-class SIMSXMLWriter(SAX.handler.ContentHandler):
+class SIMSXMLWriter():
+
+    MINNAMESCORE = 0.8      # writing another student's data into SIMS is worse than leaving a row blank
+    MATCHMETHODS = ['UPN', 'name', 'similar name', 'exam no/DOB', 'unmatched']
 
     def __init__(self, app, outfile, student_data):
         self.app = app
-        self.row = -1
         self.cell = -1
-        self.chars = []
+        self.outfile = outfile
         self.students = student_data
         # columns in student data fixed in caller: XML sheet (SIMS empty export) must have standard layout
         self.keycolumns = [0,1,2,3]
         self.UPNcolumn, self.namecolumn, self.dobcolumn, self.examcolumn = self.keycolumns
         self.studentID = None
-        self.hadDataTag = False
+        self.matchedby = None
+        self.gotExamNo = None           # exam number and dob cells seen on this row
+        self.gotDOB = None
+        # lookups built once so each key cell is matched without scanning student_data
+        self.byUPN = {}
+        self.byExamNoDOB = {}
+        for s in reversed(self.students):   # reversed so the first student in the list wins any clash
+            if s[self.UPNcolumn] != MISSING:
+                self.byUPN[s[self.UPNcolumn]] = s
+            if s[self.examcolumn] != MISSING:
+                self.byExamNoDOB[(s[self.examcolumn], s[self.dobcolumn])] = s
+        self.sortednames = sorted([(s[self.namecolumn].lower(), i) for i, s in enumerate(self.students)])
+        self.names = NameMatcher()      # fallback when SIMS name isn't a prefix of the UCAS name
+        for s in self.students:
+            self.names.add(s[self.namecolumn], s)
+        self.matchcounts = {method: 0 for method in SIMSXMLWriter.MATCHMETHODS}
+        self.seenheadings = False       # rows down to the one with the Upn heading aren't students
+
+    def write(self, template):
+        # template is the list of parts from SIMSXMLTemplate.load
+        for part in template:
+            if isinstance(part, bytes):
+                self.outfile.write(part)
+                continue
+            keycells, matched, unmatched = part
+            for cell, data in keycells:
+                if self.studentID is None:
+                    self.cell = cell
+                    self.identifyStudent(data)
+            if self.studentID:
+                self.outfile.write(b''.join([p if isinstance(p, bytes) else self.encode(self.studentID[p])
+                                             for p in matched]))
+            else:
+                self.outfile.write(unmatched)
+            self.endRow(keycells)
+        logwrite('#marksheet rows matched by ' +
+                 ', '.join([method + ': ' + str(self.matchcounts[method]) for method in SIMSXMLWriter.MATCHMETHODS]))
+
+    def encode(self, value):
+        # as XMLGenerator writes character data
+        return SAXUTILS.escape(value).encode('utf-8', 'xmlcharrefreplace')
+
+    def endRow(self, keycells):
+        # only rows with something in the key cells count as unmatched - not headings or blank rows
+        keydata = [data.strip().lower() for cell, data in keycells]
+        if self.matchedby:
+            self.matchcounts[self.matchedby] += 1
+        elif not self.seenheadings:
+            self.seenheadings = 'upn' in keydata     # marksheet always has Upn in first column
+        elif any(keydata):
+            self.matchcounts['unmatched'] += 1
+        self.studentID = None
+        self.matchedby = None
         self.gotExamNo = None
-        self.output = SAXUTILS.XMLGenerator(outfile, 'utf-8')
+        self.gotDOB = None
+
+    def getMatchCounts(self):
+        return self.matchcounts
+
+    def identifyStudent(self, data):
+        if self.cell == self.UPNcolumn:
+            if data in self.byUPN:          # UPN match
+                self.setStudent(self.byUPN[data], 'UPN')
+        elif self.cell == self.namecolumn and len(data) != 0:
+            # SIMS surname forename is a prefix of the UCAS name - names with the prefix are together in sort order
+            target = data.lower()
+            i = j = bisect.bisect_left(self.sortednames, (target, -1))
+            while j < len(self.sortednames) and self.sortednames[j][0].startswith(target):
+                j += 1
+            exact = [n for name, n in self.sortednames[i:j] if name == target]
+            if j - i == 1 or len(exact) == 1:
+                self.setStudent(self.students[exact[0] if exact else self.sortednames[i][1]], 'name')
+            elif j - i > 1:
+                # eg SMITH J for SMITH John and SMITH Jane - other key cells may still identify the student
+                logwrite('marksheet name ' + data + ' could be any of ' +
+                         ', '.join([self.students[n][self.namecolumn] for name, n in self.sortednames[i:j]]) +
+                         ' - not matched by name')
+            else:
+                # only accept a similar name if it is clearly better than the runner-up
+                ranked = self.names.lookup(data, limit=2, minscore=SIMSXMLWriter.MINNAMESCORE)
+                if len(ranked) == 1 or (len(ranked) > 1 and ranked[0][0] - ranked[1][0] >= 0.1):
+                    self.setStudent(ranked[0][1], 'similar name')
+        elif self.cell in (self.examcolumn, self.dobcolumn) and len(data) != 0:
+            # exam number and dob must both match - cells may come in either order
+            if self.cell == self.examcolumn:
+                self.gotExamNo = data
+            else:
+                self.gotDOB = data
+            if (self.gotExamNo, self.gotDOB) in self.byExamNoDOB:
+                self.setStudent(self.byExamNoDOB[(self.gotExamNo, self.gotDOB)], 'exam no/DOB')
+
+    def setStudent(self, s, method):
+        self.studentID = s
+        self.matchedby = method
+        logwrite('@set student from ' + method)
+
+class SIMSXMLTemplate(SAX.handler.ContentHandler):
+    # Compiles an empty SIMS marksheet export into a list of parts that SIMSXMLWriter streams out:
+    # bytes copied as they are, and per row a tuple of
+    #   (key cells as (cell, data) to identify the student,
+    #    parts for a matched row - bytes, or the student data column to write there,
+    #    bytes for an unmatched row)
+    # The layout of a marksheet doesn't change between exports so compiled parts are cached
+    # by marksheet, in memory and in the data folder, along with a hash of the file so that a changed
+    # marksheet is compiled again and replaces its cache
+
+    cache = {}      # k=marksheet path, v=(sha256 of marksheet file, compiled parts)
+
+    def __init__(self):
+        self.parts = []
+        self.row = None         # (keycells, matched, unmatched) while inside a Row
+        self.cell = -1
+        self.chars = []
+        self.hadDataTag = False
+        self.buffer = io.BytesIO()
+        self.output = SAXUTILS.XMLGenerator(self.buffer, 'utf-8')
+
+    @staticmethod
+    def load(app, filename):
+        with open(filename, 'rb') as f:
+            content = f.read()
+        key = hashlib.sha256(content).hexdigest()
+        path = os.path.abspath(filename)
+        if path in SIMSXMLTemplate.cache and SIMSXMLTemplate.cache[path][0] == key:
+            logwrite('#using compiled marksheet ' + key[:16] + ' for ' + filename)
+            return SIMSXMLTemplate.cache[path][1]
+        parts = None
+        name = hashlib.sha256(path.encode('utf-8')).hexdigest()
+        cachefile = app.getFullPath('PKLPATH') + 'marksheet-' + name[:16] + '.pkl'
+        if os.path.isfile(cachefile):
+            f = app.trytoopen(cachefile, 'unable to load compiled marksheet %F', mode='rb')
+            if f != TaurusApp.OPENFAIL:
+                try:
+                    with f:
+                        if pickle.load(f) == TaurusApp.SHEETFILETOKEN and pickle.load(f) == key:
+                            parts = pickle.load(f)
+                            logwrite('#loaded compiled marksheet from ' + cachefile)
+                except (EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError) as e:
+                    # truncated, or saved by an older version - parse the marksheet again
+                    logwrite('#compiled marksheet ' + cachefile + ' unreadable (' + str(e) + ') - removed')
+                    try:
+                        os.remove(cachefile)
+                    except OSError:
+                        pass
+        if parts is None:
+            logwrite('@begin SAX parse of ' + filename)
+            template = SIMSXMLTemplate()
+            SAX.parseString(content, template)
+            parts = template.getParts()
+            f = app.trytoopen(cachefile, 'unable to save compiled marksheet %F', mode='wb')
+            if f != TaurusApp.OPENFAIL:
+                with f:
+                    pickle.dump(TaurusApp.SHEETFILETOKEN, f)
+                    pickle.dump(key, f)
+                    pickle.dump(parts, f)
+        SIMSXMLTemplate.cache[path] = (key, parts)
+        return parts
+
+    def getParts(self):
+        return self.parts
+
+    def emit(self, matched=True, unmatched=True):
+        # move whatever XMLGenerator has written into the current part(s)
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        if self.row is None:
+            if self.parts and isinstance(self.parts[-1], bytes):
+                self.parts[-1] += data
+            else:
+                self.parts.append(data)
+        else:
+            if matched:
+                self.addMatched(data)
+            if unmatched:
+                self.row[2].append(data)
+
+    def addMatched(self, part):
+        # bytes are merged so a matched row alternates bytes and student data columns
+        matched = self.row[1]
+        if isinstance(part, bytes) and matched and isinstance(matched[-1], bytes):
+            matched[-1] += part
+        else:
+            matched.append(part)
 
     def startDocument(self):
         self.output.startDocument()
+        self.emit()
 
     def processingInstruction(self, target, data):
         self.output.processingInstruction(target, data)
+        self.emit()
 
     def endDocument(self):
         self.output.endDocument()
+        self.emit()
 
     def characters(self, content):
         self.chars.append(content)
@@ -2886,102 +4956,88 @@ class SIMSXMLWriter(SAX.handler.ContentHandler):
                 self.cell = index
         elif name=="Row":
             self.cell = -1
-            self.row += 1
+            self.row = ([], [], [])
         self.output.characters(''.join(self.chars))
         self.chars=[]
         self.output.startElement(name, attrs)
+        self.emit()
 
     def endElement(self, name):
         # end of row - clear 'memory' variables in case it was the last row
         if name == 'Row':
             self.hadDataTag = False
-            self.studentID = None
         # collect data from between tags
         data = ''.join(self.chars)
+        self.chars = []
         # student ID cells are: 0,1,2,3 = upn, names, dob and exam no
         # endelement will be called per Excel cell:
         # once if <cell> has no <data> inside
         # twice if both <cell> has <data> inside
-        if self.cell <= 3:
-            # in these cells try to identify which student this row is
-            if self.studentID is None:
-                self.identifyStudent(data)
-            # now just output what's already there because
-            # student ID won't be changed and any other rows mustn't be altered
+        if self.cell <= 3 or self.row is None or name == 'Row':
+            # key cells are kept to identify which student this row is, but they
+            # and anything outside student cells are output as they are
+            if self.cell <= 3 and self.row is not None and name != 'Row':
+                self.row[0].append((self.cell, data))
             self.output.characters(data)
-            self.chars = []
             self.output.endElement(name)
-        elif self.studentID:
-            # currently working on a student row
+            self.emit()
+        else:
+            # matched student row
             if name == 'Cell' and not self.hadDataTag:
                 # end of cell with no data inside: need to output the
                 # passed-in data inside a data tag and close the cell also
                 self.output.startElement('Data', attrs={'ss:Type':'String'})
-                self.output.characters(self.studentID[self.cell])     #   write passed-in data
+                self.emit(unmatched=False)
+                self.addMatched(self.cell)
                 self.output.endElement('Data')
                 self.output.endElement('Cell')
-                self.chars = []
                 # will be starting a new cell so clear the flag
                 self.hadDataTag = False
             else:
                 # end of cell on student row but had data tag - pass on to just output
-                if name == 'Cell' and self.hadDataTag:
-                    pass
-                else:   # otherwise note that we saw a data tag if we did
-                    if name == 'Data':
-                        self.hadDataTag = True
-                        self.output.characters(self.studentID[self.cell])
-                self.chars = []
+                # otherwise note that we saw a data tag if we did
+                if name == 'Data':
+                    self.hadDataTag = True
+                    self.addMatched(self.cell)
                 self.output.endElement(name)
-        else:   # anything else just copy out
+            self.emit(unmatched=False)
+            # unmatched row - just copy out
             self.output.characters(data)
-            self.chars = []
             self.output.endElement(name)
-
-    def identifyStudent(self, data):
-        if self.cell == self.UPNcolumn:
-            for s in self.students:
-                if data == s[0]:        # UPN match
-                    self.studentID = s
-                    logwrite('@set student from upn')
-                    break
-        elif self.cell == self.namecolumn and len(data) != 0:
-            for s in self.students:
-                if data.lower() == s[1].lower()[:len(data)]:    # SIMS surname forename exact match
-                    self.studentID = s
-                    logwrite('@set student from name')
-                    break
-        elif self.cell == self.examcolumn:
-            for s in self.students:
-                if data == s[3]:        # exam number matches (probably ok) ...
-                    self.gotExamNo = s
-                    logwrite('@temp set student from exno')
-                    break
-        elif self.cell == self.dobcolumn:
-            for s in self.students:     # ... and dob matches too - that'll do
-                if data == s[2]:
-                    if self.gotExamNo == s:
-                        self.studentID = s
-                    logwrite('@set student from examno/dob')
-                    break
-            self.gotExamNo = None
+            self.emit(matched=False)
+        if name == 'Row':
+            keycells, matched, unmatched = self.row
+            self.parts.append((keycells, matched, b''.join(unmatched)))
+            self.row = None
 
 class SIMSXMLReader(SAX.handler.ContentHandler):
-    def __init__(self):
+    # Iterating the reader feeds the marksheet to an incremental SAX parser a block at a time and
+    # yields each row as a list of cell strings once its block is parsed, so memory use doesn't
+    # grow with the size of the sheet and rows can be processed while the rest is still being read
+
+    BLOCKSIZE = 64 * 1024
+
+    def __init__(self, filename):
+        self.filename = filename
         self.chars=[]
         self.cells=[]
-        self.rows=[]
-        self.ptr = -1
-
-    def __next__(self):
-        self.ptr += 1
-        if self.ptr >= len(self.rows):
-            raise StopIteration
-        else:
-            return self.rows[self.ptr]
+        self.rows=[]        # rows completed in the current block only
 
     def __iter__(self):
-        return self
+        parser = SAX.make_parser()
+        parser.setContentHandler(self)
+        with open(self.filename, 'rb') as f:
+            block = f.read(SIMSXMLReader.BLOCKSIZE)
+            while block:
+                parser.feed(block)
+                yield from self.takeRows()
+                block = f.read(SIMSXMLReader.BLOCKSIZE)
+            parser.close()
+        yield from self.takeRows()
+
+    def takeRows(self):
+        rows, self.rows = self.rows, []
+        return rows
 
     def characters(self, content):
         self.chars.append(content)
@@ -0,0 +1,156 @@
+#########################################################################################################
+#
+#  TAURUS benchmarks - timings for the cohort-wide calculations on synthetic data
+#                      run with: python taurusBench.py
+#
+#########################################################################################################
+
+import os
+import random
+import tempfile
+import time
+import taurus
+
+def quiet(message):
+    pass
+
+def timed(label, function, *args):
+    start = time.perf_counter()
+    value = function(*args)
+    print('{:<40}{:>10.3f}s'.format(label, time.perf_counter() - start))
+    return value
+
+##### Synthetic data
+
+GRADES = ['A*', 'A', 'B', 'C', 'D', 'E', 'U', 'X']
+OFFERS = ['A*AA', 'AAA', 'AAB', 'ABB', 'BBB', 'BBC', 'BCC', 'CCC', 'CCD', 'A*A*A', 'AAAB', 'ABBD',
+          '112', '120', '128', '136', '96', '80', '48', 'AAB1', 'BBB2', 'A*AAD', 'ABBX', '']
+
+def syntheticResults(count, rng):
+    return [taurus.Offer.fromString(''.join([rng.choice(GRADES[:6]) if rng.random() < 0.98 else rng.choice(GRADES)
+                                             for i in range(rng.choice([2, 3, 3, 3, 4]))]))
+            for n in range(count)]
+
+def syntheticOffers(count, rng):
+    return [taurus.Offer.fromString(rng.choice(OFFERS)) for n in range(count)]
+
+SUBJECTS = ['Ma', 'Fm', 'Ph', 'Ch', 'Bi', 'En', 'Hi', 'Gg', 'Ec', 'Ps']
+UNIS = ['LEEDS', 'YORK', 'BATH', 'DURHAM', 'EXETER', 'WARWICK', 'BRISTOL', 'NOTTINGHAM', 'SHEFFIELD', 'KCL']
+COURSES = ['Physics', 'Mathematics', 'History', 'English', 'Medicine', 'Law', 'Chemistry', 'Economics']
+OUTCOMES = ['C', 'C', 'U', 'REJ', 'INV', 'REF', 'W', 'CD', 'UD']
+ASRDATE = '01042017'
+
+def syntheticCohort(count, rng, thedate=ASRDATE):
+    # StudentManager with count students, each with up to 5 choices (one firm, one insc) and predictions
+    studentmanager = taurus.StudentManager(None)
+    studentmanager.addDate(thedate)
+    for n in range(count):
+        student = taurus.Student('SURNAME{:05d}'.format(n), 'Forename', '01-JAN-99', str(1000000000 + n), '1',
+                                 'AB{} {}CD'.format(rng.randint(1, 99), rng.randint(1, 9)))
+        studentmanager.students.append(student)
+        choices = rng.randint(0, 5)
+        firm = rng.randint(1, choices) if choices else 0
+        insc = rng.randint(1, choices) if choices > 1 else 0
+        for c in range(1, choices + 1):
+            outcome = rng.choice(OUTCOMES)
+            if c == firm:
+                outcome = rng.choice(['CF', 'CF', 'UF'])
+            elif c == insc:
+                outcome = 'CI'
+            student.addChoice(thedate, taurus.Choice(str(c), 'X' + str(c), rng.choice(UNIS), 'C' + str(c),
+                                                     rng.choice(COURSES), outcome, rng.choice(OFFERS)))
+        for subject in rng.sample(SUBJECTS, rng.choice([2, 3, 3, 3, 4])):
+            student.addPrediction(subject, rng.choice(GRADES[:6]))
+    return studentmanager
+
+def syntheticYear(count, rng, numdates=20):
+    # cohort as syntheticCohort with the same choices at numdates fortnightly ASR dates, outcomes redrawn
+    studentmanager = syntheticCohort(count, rng)
+    first = taurus.datetime.datetime.strptime(ASRDATE, '%d%m%Y')
+    for d in range(1, numdates):
+        thedate = (first - taurus.datetime.timedelta(days=14 * d)).strftime('%d%m%Y')
+        studentmanager.addDate(thedate)
+        for student in studentmanager.getStudents():
+            for choice in student.getChoices(ASRDATE):
+                student.addChoice(thedate, taurus.Choice(choice.getID(), 'X', choice.getUni(), 'C',
+                                                         choice.getCrsText(), rng.choice(OUTCOMES),
+                                                         rng.choice(OFFERS)))
+    return studentmanager
+
+class BenchApp():
+    # the parts of TaurusApp that the reports use
+
+    def __init__(self, studentmanager):
+        self.studentmanager = studentmanager
+        self.subjectmanager = taurus.SubjectManager(self)
+
+    def getStudentManager(self):
+        return self.studentmanager
+
+    def getSubjectManager(self):
+        return self.subjectmanager
+
+    trytoopen = taurus.TaurusApp.trytoopen
+
+##### Benchmarks
+
+def benchmarkGradeCompare(count=50000, seed=2017):
+    rng = random.Random(seed)
+    results = syntheticResults(count, rng)
+    offers = syntheticOffers(count, rng)
+    print('gradeCompare over ' + str(count) + ' pairs, numpy ' + ('not installed' if taurus.NP is None else taurus.NP.__version__))
+    for warn in (True, False):
+        scalar = timed('  scalar gradeCompare (warn=' + str(warn) + ')',
+                       lambda: [r.gradeCompare(o, warn) for r, o in zip(results, offers)])
+        batch = timed('  gradeCompareBatch (warn=' + str(warn) + ')', taurus.Offer.gradeCompareBatch, results, offers, warn)
+        assert scalar == batch, 'batch outcome codes differ from gradeCompare'
+
+def benchmarkAdmissionSimulator(count=10000, samples=10000, seed=2017):
+    cohort = syntheticCohort(count, random.Random(seed)).getEvaluation()
+    simulator = taurus.AdmissionSimulator(samples)
+    print('admission simulator, ' + str(count) + ' students x ' + str(samples) + ' samples')
+    pfirm, pinsc = timed('  simulate', simulator.simulate, cohort)
+    print('  mean P(firm) {:.3f}, P(insc) {:.3f}'.format(sum(pfirm) / count, sum(pinsc) / count))
+
+def benchmarkParallelReports(count=20000, processes=None, seed=2017):
+    app = BenchApp(syntheticCohort(count, random.Random(seed)))
+    jobs = [(taurus.OffersReport, (True,), 'offers-all'),
+            (taurus.ByStudentReport, (), 'byStudent'),
+            (taurus.ByUniReport, (), 'byUni'),
+            (taurus.DestinationsReport, (), 'destinations'),
+            (taurus.AtRiskReport, (), 'atRisk'),
+            (taurus.ClearingReport, (), 'clearing'),
+            (taurus.AdmissionProbabilityReport, (), 'admission')]
+    print('all reports, ' + str(count) + ' students, ' + str(os.cpu_count()) + ' cpus')
+    with tempfile.TemporaryDirectory() as serialpath, tempfile.TemporaryDirectory() as parallelpath:
+        serial = taurus.ReportPipeline(app.getStudentManager(),
+                                       [(reportclass(app, *args), os.path.join(serialpath, name + '.csv'))
+                                        for reportclass, args, name in jobs])
+        parallel = taurus.ParallelReportRunner(app, [(reportclass, args, os.path.join(parallelpath, name + '.csv'))
+                                                     for reportclass, args, name in jobs], processes)
+        start = time.perf_counter()
+        timed('  serial pipeline', serial.run)
+        middle = time.perf_counter()
+        timed('  parallel, ' + str(parallel.processes) + ' processes', parallel.run)
+        print('  speedup {:.2f}x'.format((middle - start) / (time.perf_counter() - middle)))
+        for reportclass, args, name in jobs:
+            with open(os.path.join(serialpath, name + '.csv'), 'rb') as s, \
+                 open(os.path.join(parallelpath, name + '.csv'), 'rb') as p:
+                assert s.read() == p.read(), name + ' report differs between serial and parallel runs'
+
+def benchmarkChoiceQuery(count=2000, numdates=20, seed=2017):
+    studentmanager = syntheticYear(count, random.Random(seed), numdates)
+    table = timed('  build choice table', studentmanager.getChoiceTable)
+    print('choice queries, ' + str(table.getNumRows()) + ' choices over ' + str(numdates) + ' ASR dates')
+    for query in ['count by uni where outcome=REJ and date>=previous',
+                  'count, mean(offerpoints) by uni, course where outcome=C,U',
+                  'sum(firm), sum(insc), max(offerpoints) by date, uni',
+                  'count by name where offerpoints>=120 and declined=0']:
+        headings, rows = timed('  ' + query[:38], table.query, query)
+
+if __name__ == "__main__":
+    taurus.logwrite = quiet
+    benchmarkGradeCompare()
+    benchmarkAdmissionSimulator()
+    benchmarkParallelReports()
+    benchmarkChoiceQuery()
@@ -1,6 +1,7 @@
 import tkinter as TK
 import tkinter.scrolledtext as TKST
 import tkinter.filedialog as TKFD
+import tkinter.simpledialog as TKSD
 
 #########################################################################################################
 #
@@ -56,9 +57,15 @@ class TaurusGUI(TK.Tk):
     def fileOpenDialog(self, **opts):
         return str(TKFD.askopenfilename(**opts))
 
+    def fileOpenMultipleDialog(self, **opts):
+        return self.tk.splitlist(TKFD.askopenfilenames(**opts))
+
     def fileSaveAsDialog(self, **opts):
         return str(TKFD.asksaveasfilename(**opts))
 
+    def askString(self, title, prompt):
+        return TKSD.askstring(title, prompt, parent=self)
+
     def warning(self, message):
         message = self.app.preprocesswarning(message)
         self.logwin.log.configure(state=TK.NORMAL)
@@ -296,6 +303,11 @@ class ReportLayout(Layout):
 
     def fillLayout(self):
         self.images = [ TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
+                        TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
+                        TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
+                        TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
+                        TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
+                        TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
                         TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
                         TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
                         TK.PhotoImage(file=TaurusGUI.IMAGEPATH+'import.gif').zoom(2).subsample(3),
@@ -310,6 +322,11 @@ class ReportLayout(Layout):
                            lambda: self.app.reportDestinations(),
                            lambda: self.app.reportAtRisk(),
                            lambda: self.app.reportBySubject(),
+                           lambda: self.app.reportAdmissionProbability(),
+                           lambda: self.app.reportClearing(),
+                           lambda: self.app.reportTrends(),
+                           lambda: self.app.reportQuery(),
+                           lambda: self.app.reportAll(),
                            lambda: self.parent.select('home') ]
         self.buttons = []
         for i in range(len(self.images)):
@@ -321,6 +338,11 @@ class ReportLayout(Layout):
                         TK.Label(self, text='Destinations', font=TaurusGUI.LABELFONT),
                         TK.Label(self, text='At Risk', font=TaurusGUI.LABELFONT),
                         TK.Label(self, text='By Subject', font=TaurusGUI.LABELFONT),
+                        TK.Label(self, text='Admission Chances', font=TaurusGUI.LABELFONT),
+                        TK.Label(self, text='Clearing', font=TaurusGUI.LABELFONT),
+                        TK.Label(self, text='Trends', font=TaurusGUI.LABELFONT),
+                        TK.Label(self, text='Query', font=TaurusGUI.LABELFONT),
+                        TK.Label(self, text='All Reports', font=TaurusGUI.LABELFONT),
                         TK.Label(self, text='Back', font=TaurusGUI.LABELFONT) ]
         for i in range(len(self.images)):
             if self.callbacks[i]:           # allow for blanks in grid
@@ -329,6 +351,8 @@ class ReportLayout(Layout):
             self.columnconfigure(i%4, weight=1)
         self.rowconfigure(0, pad=25, weight=1)
         self.rowconfigure(2, pad=25, weight=1)
+        self.rowconfigure(4, pad=25, weight=1)
+        self.rowconfigure(6, pad=25, weight=1)
 
 ###############################################################################################################
 #
@@ -371,6 +395,7 @@ class BrowseLayout(Layout):
         self.bottomframe = BrowseBottom(self)
         self.searchframe = SearchBottom(self)
         self.topframe.pack(side=TK.TOP, fill=TK.X, expand=False)
+        self.searching = False      # search results showing rather than the student
         self.choose('browse')
 
     def studentL(self):
@@ -403,8 +428,10 @@ class BrowseLayout(Layout):
             # srch.get(), do the searching then update the table widget in self.searchframe.tableGet()
             self.searchframe.pack(side=TK.TOP, fill=TK.BOTH, expand=True)
             self.searchframe.restart()      # reset search list to the top
+            self.searching = True
         elif flag == 'browse' or True:      # ie all otherwise
             self.searchframe.pack_forget()
+            self.searching = False
             self.resetChosenDate()
             self.bottomframe.pack(side=TK.TOP, fill=TK.BOTH, expand=True)
         self.refreshData()
@@ -424,7 +451,8 @@ class BrowseLayout(Layout):
         except AttributeError:     # not instantiated yet
             self.dateshowing.set('')
         self.bottomframe.refreshData()
-        self.searchframe.refreshData()
+        if self.searching:
+            self.searchframe.refreshData()
         # reattach Enter key - is unbound when browse is closed
         self.rootwindow.bind("<Return>", self.topframe.enterPressed)
 
@@ -475,9 +503,11 @@ class BrowseTop(Layout):
         # choosebox left of navbox
         self.choosebox.pack(side=TK.LEFT, fill=TK.BOTH, expand=True)
         self.navbox.pack(side=TK.RIGHT, fill=TK.BOTH, expand=True)
-        # press return to search
+        # press return to search, or just type
         rootwindow = self.parent.rootwindow
         rootwindow.bind("<Return>", self.enterPressed)
+        self.lastterm = ''
+        self.srch.bind("<KeyRelease>", self.keyReleased)
 
     def close(self):
         mainwindow = self.parent.parent
@@ -488,6 +518,13 @@ class BrowseTop(Layout):
     def enterPressed(self, e):
         self.parent.choose('search')
 
+    def keyReleased(self, e):
+        # search as the term changes - the search runs on the worker thread so typing carries on
+        if self.getSearchTerm() != self.lastterm:
+            self.lastterm = self.getSearchTerm()
+            if self.lastterm:
+                self.parent.choose('search')
+
     def getSearchTerm(self):
         return self.srch.get()
 
@@ -571,6 +608,8 @@ class BrowseBottom(Layout):
 
 class SearchBottom(Layout):
 
+    POLLTIME = 50   # ms between checks for pages from the search worker
+
     def __init__(self, parent, *args, **kwargs):
         TK.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
@@ -584,6 +623,10 @@ class SearchBottom(Layout):
                                 self.widths, self.headings, self.justify, True)
         self.table.pack(side=TK.TOP, fill=TK.X, pady=20)
         self.startat = 0
+        self.generation = None  # of the search whose pages are wanted
+        self.sortcolumn = 0
+        self.asking = False     # a request is due once the current event has been handled
+        self.polling = False
 
     def getGUIManager(self):
         return self.parent.getGUIManager()
@@ -595,27 +638,63 @@ class SearchBottom(Layout):
             self.startat = 0    # next search starts at top
 
     def refreshData(self, sortcolumn=0):
+        # the search worker is asked once the event is handled, so one key press makes one request however
+        # many times this is called - the page is shown by poll() when ready
+        if self.getGUIManager():
+            self.sortcolumn = sortcolumn
+            if not self.asking:
+                self.asking = True
+                self.after_idle(self.askWorker)
+        else:
+            self.showPage([], 0, sortcolumn)
+
+    def askWorker(self):
+        self.asking = False
+        guimanager = self.getGUIManager()
+        self.generation = guimanager.getSearchWorker().request(self.parent.getSearchTerm().lower(),
+                                                               guimanager.getDate(), self.sortcolumn,
+                                                               self.startat, self.tablerows-2)
+        if not self.polling:
+            self.polling = True
+            self.after(SearchBottom.POLLTIME, self.poll)
+
+    def poll(self):
+        # stops once the latest request's full page arrives or it is dropped
+        self.polling = False
+        for generation, page, total in self.getGUIManager().getSearchWorker().getPages():
+            if generation != self.generation:
+                continue    # superseded
+            if page is None:
+                self.refreshData(self.sortcolumn)   # dropped as data was imported since - ask again
+                return
+            self.showPage(page, total, self.sortcolumn)
+            if total is not None:
+                return
+        self.polling = True
+        self.after(SearchBottom.POLLTIME, self.poll)
+
+    def showPage(self, page, total, sortcolumn):
+        # total is None while the full search is still going
         # clear table setting special cells appropriately
         studentID = 0 if self.getGUIManager() is None else self.getGUIManager().getStudentIndex()
         self.table.clear(self.cmd, studentID, '[Exit Search]')
         # paint data onto table widgets
-        if self.getGUIManager():
-            dataset = self.getGUIManager().search(self.parent.getSearchTerm().lower(), sortcolumn)
-            for i in range(self.startat, min(self.startat+self.tablerows-2, len(dataset))):
-                # lambda closure see https://docs.python.org/3/faq/programming.html
-                # #why-do-lambdas-defined-in-a-loop-with-different-values-all-return-the-same-result
-                self.table.setbutton(i-self.startat+1, dataset[i][1],
-                                     lambda u=dataset[i][0]: self.cmd(u))
-                for j in range(1, self.tablecols):  # tablecols excludes the name
-                    self.table.set(i-self.startat+1, j, dataset[i][j+1])
-            # set navigation widgets in table
-            if self.startat+self.tablerows-2 >= len(dataset):
-                self.table.setbutton(self.tablerows-1, '[Top]', lambda: self.tableTop(sortcolumn))
-            else:
-                self.table.setbutton(self.tablerows-1, '[More]', lambda: self.tableMore(sortcolumn))
+        for i, row in enumerate(page):
+            # lambda closure see https://docs.python.org/3/faq/programming.html
+            # #why-do-lambdas-defined-in-a-loop-with-different-values-all-return-the-same-result
+            self.table.setbutton(i+1, row[1], lambda u=row[0]: self.cmd(u))
+            for j in range(1, self.tablecols):  # tablecols excludes the name
+                self.table.set(i+1, j, row[j+1])
+        # set navigation widgets in table
+        if total is None:
+            self.table.setbutton(self.tablerows-1, '[Searching]', lambda: None)
+        elif self.startat+self.tablerows-2 >= total:
+            self.table.setbutton(self.tablerows-1, '[Top]', lambda: self.tableTop(sortcolumn))
+        else:
+            self.table.setbutton(self.tablerows-1, '[More]', lambda: self.tableMore(sortcolumn))
 
     def tableMore(self, column):
-        self.startat += self.tablerows-1
+        self.startat += self.tablerows-2    # rows of students on a page
         self.refreshData(column)
 
     def tableTop(self, column):